@@ -3,27 +3,36 @@
 
 import argparse
 from datetime import datetime, timedelta
+import io
 import logging
 import logging.handlers
 import multiprocessing
 from multiprocessing.sharedctypes import SynchronizedBase
+import os
 import sys
 import json
+import threading
 
 from apscheduler.schedulers.background import BackgroundScheduler
 #from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
 from flask import Flask, Response, render_template, request
 #from flask_sqlalchemy import SQLAlchemy
-import musicpd
+from PIL import Image
 import serial
 
 
+from classes.adaptive_poller import AdaptivePoller
 from classes.airly import Airly
 from classes.c_ro_jazz import CRoJazz
+from classes.json_from_api import JSONFromAPI
 from classes.open_weather_map import OpenWeatherMap
 from classes import wizbulb
 from classes import routines
 from classes import eink
+from classes import mpd_pool
+from classes.mpd_watcher import MPDWatcher
+from classes.shared_raster import SharedRasterReader
+from classes.timeseries import TimeSeriesStore
 
 app = Flask(__name__)
 
@@ -51,10 +60,10 @@ def prepare_logger(args) -> None:
     logging.basicConfig(format='[%(asctime)s] %(levelname)s - %(processName)s/%(threadName)s - '
         '%(pathname)s:%(lineno)d - %(name)s - %(message)s', level=level)
 
-def wrap_in_process(func, *args) -> None:
+def wrap_in_process(func, *args, **kwargs) -> None:
     """wrap passed function in separate process"""
     proc = multiprocessing.Process(target=func,
-        args=args)
+        args=args, kwargs=kwargs)
     proc.start()
 
 class PlainTextTcpHandler(logging.handlers.SocketHandler):
@@ -66,30 +75,47 @@ class PlainTextTcpHandler(logging.handlers.SocketHandler):
 def mpd(mpd_request: dict,) -> None:
     """handle mpd-related requests"""
     app.producer_wakeup_int.send(True)
-    mpd_client = musicpd.MPDClient()
-    mpd_client.connect()
+    commands = []
     if mpd_request.args['mpd'] == 'off':
-        mpd_client.clear()
+        commands = [('clear',)]
     if mpd_request.args['mpd'] == 'on':
-        mpd_client.clear()
-        #mpd_client.setvol(100)
-        mpd_client.add('https://rozhlas.stream/jazz_aac_128.aac')
-        mpd_client.play()
+        commands = [
+            ('clear',),
+            #('setvol', 100),
+            ('add', 'https://rozhlas.stream/jazz_aac_128.aac'),
+            ('play',),
+        ]
     if mpd_request.args['mpd'] == 'volume' and 'volume' in mpd_request.args:
         app.logger.error("trying to set volume: %s",
             mpd_request.args['volume'])
-        mpd_client.setvol(mpd_request.args['volume'])
+        commands = [('setvol', mpd_request.args['volume'])]
+    if commands:
+        mpd_pool.shared_pool().command_list(commands)
+
+def mpd_state() -> dict:
+    """MPD status, commands and current song
+    From the watcher's snapshot, read from MPD only while it has none.
+    """
+    snapshot = app.mpd_watcher.snapshot()
+    if snapshot is None or not app.mpd_watcher.connected:
+        status, commands, song = mpd_pool.shared_pool().command_list(
+            [('status',), ('commands',), ('currentsong',)], retry=True)
+        snapshot = {'status': status, 'commands': commands, 'song': song}
+    return snapshot
 
 @app.route('/', methods=['GET', 'POST'])
 def index() -> str:
     """Webpage with advanced controls"""
-    mpd_client = musicpd.MPDClient()
-    mpd_client.connect()
     app.logger.error("index form: %s", json.dumps(request.form))
     if 'volume' in request.form:
-        mpd_client.setvol(request.form['volume'])
+        # setvol and status are safe to repeat
+        volume = mpd_pool.shared_pool().command_list(
+            [('setvol', request.form['volume']), ('status',)],
+            retry=True)[-1]['volume']
+    else:
+        volume = mpd_state()['status']['volume']
     return render_template("index.html.j2",
-        audioVolume=mpd_client.status()['volume'])
+        audioVolume=volume)
 
 @app.route('/api', methods=['GET', 'POST'])
 async def api() -> Response:
@@ -102,13 +128,12 @@ async def api() -> Response:
         if 'mpd' in request.args:
             mpd(request)
     else:
-        mpd_client = musicpd.MPDClient()
-        mpd_client.connect()
+        state = mpd_state()
         out = await wizbulb.get_bulb(app.config)
         response = {
-            'volume': mpd_client.status()['volume'],
-            'commands': mpd_client.commands(),
-            'song': mpd_client.currentsong(),
+            'volume': state['status']['volume'],
+            'commands': state['commands'],
+            'song': state['song'],
             'bulbs': out,
         }
     response = Response(json.dumps(response, indent=2),
@@ -116,6 +141,119 @@ async def api() -> Response:
     response.headers["Content-Type"] = "application/json; charset=utf-8"
     return response
 
+@app.route('/api/history')
+def history() -> Response:
+    """Stored readings
+    ?series=pm25_outside&start=<UNIX time>&end=<UNIX time>&resolution=raw|hour|day
+    without series lists stored series, range defaults to the last day
+    """
+    series = request.args.get('series')
+    if series is None:
+        response = {'series': app.timeseries.series()}
+    else:
+        end = request.args.get('end', datetime.now().timestamp(), type=float)
+        start = request.args.get('start', end - 86400, type=float)
+        resolution = request.args.get('resolution')
+        if resolution not in TimeSeriesStore.Resolutions:
+            resolution = app.timeseries.resolution(start, end)
+        response = {
+            'series': series,
+            'resolution': resolution,
+            'columns': ['timestamp', 'min', 'mean', 'max'],
+            'data': app.timeseries.query(series, start, end, resolution),
+        }
+    response = Response(json.dumps(response),
+        200, mimetype='application/json')
+    response.headers["Content-Type"] = "application/json; charset=utf-8"
+    return response
+
+def drain_preview() -> None:
+    """Keep newest e-ink preview messages
+    Runs in its own thread, so the e-ink process never blocks on a full pipe
+    whether or not previews are requested.
+    """
+    while True:
+        try:
+            message = app.consumer_preview.recv()
+        except EOFError:
+            app.logger.error("e-ink preview pipe closed")
+            return
+        with app.preview_lock:
+            if 'frame' in message:
+                app.preview['frame'] = (message['digest'], message['frame'])
+            app.preview['forecast'] = (
+                f"{message['forecast']['shm']}-{message['forecast']['version']}",
+                message['forecast'])
+            app.preview['stats'] = message['stats']
+
+def preview_state() -> dict:
+    """Newest (etag, descriptor) per image and e-ink stats"""
+    with app.preview_lock:
+        return dict(app.preview)
+
+def preview_png(name: str, etag: str, descriptor: dict) -> bytes:
+    """Encode published image as PNG, once per etag
+    Returns None if the image was replaced before it could be copied.
+    """
+    with app.preview_lock:
+        if name in app.preview_png and app.preview_png[name][0] == etag:
+            return app.preview_png[name][1]
+        # a private copy, the writer may reuse the slot while encoding
+        image = app.preview_rasters.copy(descriptor)
+        if image is None:
+            return None
+        if name == 'frame':
+            # back from panel to portrait orientation
+            image = image.transpose(Image.Transpose.ROTATE_270)
+        if image.mode == 'RGBX':
+            image = image.convert('RGB')
+        buffer = io.BytesIO()
+        image.save(buffer, format='PNG')
+        app.preview_png[name] = (etag, buffer.getvalue())
+        return app.preview_png[name][1]
+
+@app.route('/preview/<name>.png')
+def preview(name: str) -> Response:
+    """Last e-ink frame or forecast plot, ETag is the content digest"""
+    state = preview_state()
+    if name not in ('frame', 'forecast') or name not in state:
+        return Response("no preview", 404, mimetype='text/plain')
+    etag, descriptor = state[name]
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        png = preview_png(name, etag, descriptor)
+        if png is None:
+            response = Response("preview changed, retry", 503,
+                mimetype='text/plain')
+            response.headers["Retry-After"] = "1"
+            return response
+        response = Response(png, 200, mimetype='image/png')
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+@app.route('/stats')
+def stats() -> Response:
+    """Performance counters"""
+    response = {
+        'eink': preview_state().get('stats'),
+        'cro_jazz': app.cro_jazz.stats(),
+        'forecast_plot': app.open_weather.plot_cache_stats(),
+        'http_cache': (JSONFromAPI.http_cache.stats()
+                       if JSONFromAPI.http_cache is not None else None),
+        'http': JSONFromAPI.http_stats(),
+        'airly': app.smog_airly.station_stats(),
+        'timeseries': app.timeseries.stats(),
+        'mpd': mpd_pool.shared_pool().stats(),
+        'mpd_watcher': app.mpd_watcher.stats(),
+        'polling': {poller.name: poller.stats() for poller in app.pollers},
+    }
+    response = Response(json.dumps(response, indent=2),
+        200, mimetype='application/json')
+    response.headers["Content-Type"] = "application/json; charset=utf-8"
+    return response
+
 #scheduled job
 def add_alarms(sched: BackgroundScheduler,
         consumer_wakeup_int: multiprocessing.connection.Connection,
@@ -143,8 +281,11 @@ def add_alarms(sched: BackgroundScheduler,
 
 #process
 def tcplog(tcplog_consumer: multiprocessing.connection.Connection,
-        host: str, port: int) -> None:
-    """Send text from pipe to TCP"""
+        host: str, port: int, timeseries: dict = None) -> None:
+    """Send text from pipe to TCP, store readings in JSON lines
+    Args:
+        timeseries (dict, optional): `TimeSeriesStore` arguments
+    """
     log = logging.getLogger("tcplog")
     log_handler = PlainTextTcpHandler(host, port)
     log_handler.setFormatter(logging.Formatter('%(message)s'))
@@ -152,10 +293,17 @@ def tcplog(tcplog_consumer: multiprocessing.connection.Connection,
         log.removeHandler(handler)
     log.addHandler(log_handler)
     log.propagate = False
+    store = TimeSeriesStore(**timeseries) if timeseries is not None else None
     app.logger.warning("tcplog: starting loop")
     while True:
+        if store is not None and not tcplog_consumer.poll(store.flush_interval):
+            store.flush_if_due()
+            continue
         app.logger.info("tcplog: consuming")
-        log.error(tcplog_consumer.recv())
+        message = tcplog_consumer.recv()
+        log.error(message)
+        if store is not None:
+            store.add_json(message)
 
 #process
 def serial_to_log(tcplog_producer:
@@ -183,6 +331,8 @@ def main():
                         help="debug mode")
     parser.add_argument("-dd", "--trace", "-vv", action="store_true",
                         help="debug mode")
+    parser.add_argument("--headless", action="store_true",
+                        help="simulate e-ink panel, see /preview/frame.png")
     args = parser.parse_args()
 
     prepare_logger(args)
@@ -201,14 +351,24 @@ def main():
     #    multiproc_logger.removeHandler(handler)
     #multiproc_logger.addHandler(log_handler)
 
+    if 'HTTP_CACHE' in app.config:
+        JSONFromAPI.configure_cache(**app.config['HTTP_CACHE'])
+    if 'HTTP' in app.config:
+        JSONFromAPI.configure_http(**app.config['HTTP'])
+    JSONFromAPI.configure_snapshots(app.config.get('SNAPSHOT_DIR',
+                                                   'cache/snapshots'))
+    timeseries_config = app.config.get('TIMESERIES',
+                                       {'path': 'cache/timeseries.sqlite3'})
     app.cro_jazz = CRoJazz()
     app.open_weather = OpenWeatherMap(
         app.config['FORECAST']['forecastLocation'],
-        app.config['FORECAST']['forecastToken']
+        app.config['FORECAST']['forecastToken'],
+        app.config['FORECAST'].get('plotBackend', 'matplotlib')
         )
     app.smog_airly = Airly(
         app.config['FORECAST']['smogLocations'],
-        app.config['FORECAST']['airlyToken']
+        app.config['FORECAST']['airlyToken'],
+        app.config['FORECAST'].get('airlyMode', Airly.ModeHedged)
         )
 
     app.flag_radio_playing = multiprocessing.Value('i', 1)
@@ -218,29 +378,61 @@ def main():
     consumer_arl, producer_arl = multiprocessing.Pipe()
     consumer_tcplog, producer_tcplog = multiprocessing.Pipe()
     consumer_wakeup_int, app.producer_wakeup_int = multiprocessing.Pipe()
+    app.consumer_preview, producer_preview = multiprocessing.Pipe()
+    app.preview = {}
+    app.preview_png = {}
+    app.preview_lock = threading.Lock()
+    app.preview_rasters = SharedRasterReader()
 
     #APP.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///app.db'
     #DB = SQLAlchemy(APP)
+    # first frame from restored or just fetched data, without waiting for
+    # the scheduler
+    app.cro_jazz.send(producer_cro)
+    app.open_weather.send(producer_opw)
+    app.smog_airly.send(producer_arl)
+
     scheduler = BackgroundScheduler()
     scheduler_start = datetime.now()+timedelta(seconds=30)
-    scheduler.add_job(
-        app.cro_jazz.update,
-        trigger = 'interval',
-        args = [producer_cro],
-        minutes=1,
-        start_date=scheduler_start)
-    scheduler.add_job(
-        app.open_weather.update,
-        trigger = 'interval',
-        args = [producer_opw],
-        hours=1,
-        start_date=scheduler_start)
-    scheduler.add_job(
-        app.smog_airly.update,
-        trigger = 'interval',
-        args = [producer_arl],
-        hours=1,
-        start_date=scheduler_start)
+    # restored providers are refreshed right away in background
+    app.cro_jazz.schedule_updates(
+        scheduler,
+        producer_cro,
+        datetime.now() if app.cro_jazz.restored else scheduler_start)
+    polling = app.config.get('POLLING', {})
+    app.pollers = [
+        AdaptivePoller(
+            'open_weather',
+            app.open_weather.update,
+            [producer_opw],
+            # API updates forecasts every 3 hours
+            lambda: (app.open_weather.forecast.digest()
+                     if app.open_weather.forecast is not None else None,),
+            **dict({
+                'interval': 3600,
+                'min_interval': 1800,
+                'max_interval': 3 * 3600,
+                'hosts': ['http://api.openweathermap.org'],
+            }, **polling.get('open_weather', {}))),
+        AdaptivePoller(
+            'smog_airly',
+            app.smog_airly.update,
+            [producer_arl],
+            lambda: (app.smog_airly.pm025, app.smog_airly.pm100),
+            alert=lambda: app.smog_airly.pm025 > app.smog_airly.pm025_limit,
+            **dict({
+                'interval': 3600,
+                'min_interval': 900,
+                'max_interval': 3 * 3600,
+                # free Airly API key
+                'quota': 100,
+                'hosts': ['https://airapi.airly.eu'],
+            }, **polling.get('smog_airly', {}))),
+    ]
+    app.pollers[0].start(scheduler, datetime.now() if app.open_weather.restored
+                         else scheduler_start)
+    app.pollers[1].start(scheduler, datetime.now() if app.smog_airly.restored
+                         else scheduler_start)
     scheduler.add_job(
         app.open_weather.schedule_at_sunset,
         trigger = 'cron',
@@ -255,19 +447,31 @@ def main():
 
     add_alarms(scheduler, consumer_wakeup_int, app.flag_master_switch)
 
-    wrap_in_process(tcplog, consumer_tcplog, '127.0.0.1', 5170)
+    wrap_in_process(tcplog, consumer_tcplog, '127.0.0.1', 5170,
+                    timeseries_config)
     wrap_in_process(serial_to_log, producer_tcplog)
     #polling bulp with ping is unreliable :/
     #wrap_in_process(routines.bulbs_state, app.config, app.flag_master_switch)
+    if args.headless:
+        os.environ['EPD_BACKEND'] = 'sim'
     wrap_in_process(
         eink.update_eink,
         consumer_cro,
         consumer_opw,
         consumer_arl,
         producer_tcplog,
-        app.flag_radio_playing
+        app.flag_radio_playing,
+        producer_preview=producer_preview
         )
 
+    # queries only, readings are written by the tcplog process; opened
+    # after forking, SQLite connections must not cross processes
+    app.timeseries = TimeSeriesStore(**timeseries_config)
+    app.mpd_watcher = MPDWatcher()
+    app.mpd_watcher.start()
+    threading.Thread(target=drain_preview, name='drain_preview',
+                     daemon=True).start()
+
     scheduler.start()
     app.run()
 
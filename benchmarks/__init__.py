@@ -0,0 +1,3 @@
+# __init__.py
+"""Benchmarks runnable off the Pi, e.g. `python -m benchmarks.epd_display`
+"""
@@ -0,0 +1,109 @@
+# eink_render.py
+"""Compare e-ink frame rendering: RGB draw + quantize + rotate, cached
+layers in RGB, and cached layers drawn natively in panel palette
+
+`--check` only compares the compositor with the legacy frame and exits
+with status 1 if any pixel of the 'rgb' mode frame differs; 'native' mode
+thresholds antialiased text edges, its differences are only reported.
+"""
+import argparse
+import sys
+import time
+
+from PIL import Image, ImageDraw, ImageFont
+
+from classes.compositor import Compositor
+
+TEXT = {
+    'date': ('2024-01-01', 40, (0, 0, 0)),
+    # descenders and a diacritic reach the band edges
+    'track': ('ČRoJazz: Dizzy Gillespie - Groovin\' High (Jg_y)', 12, (0, 0, 0)),
+    'smog': ('Smog:    12.1/25.3/40.8', 12, (255, 0, 0)),
+    'temperature': ('Temp:    3.2°', 12, (0, 0, 0)),
+}
+
+def forecast_image() -> Image:
+    """Stand-in for the forecast plot"""
+    image = Image.new('RGB', (420, 200), (0xFF, 0xFF, 0xFF))
+    draw = ImageDraw.Draw(image)
+    draw.polygon([(40, 190), (120, 120), (260, 170), (400, 190)], fill=0)
+    draw.line([(40, 60), (200, 20), (400, 90)], fill=(255, 0, 0), width=2)
+    return image
+
+def legacy_frame(plot: Image, palette: Image) -> Image:
+    """Frame as rendered before the compositor"""
+    font_big = ImageFont.truetype('SourceCodePro-Regular.ttf', 40)
+    font_small = ImageFont.truetype('SourceCodePro-Regular.ttf', 12)
+    image = Image.new('RGB', (384, 640), (0xFF, 0xFF, 0xFF))
+    image.paste(plot, (-20, 430))
+    draw = ImageDraw.Draw(image)
+    # positions of the original ImageDraw code
+    tops = {'date': 0, 'track': 61, 'smog': 77, 'temperature': 93}
+    for name, (text, size, fill) in TEXT.items():
+        draw.text((10, tops[name]), text, fill=fill,
+                  font=font_big if size == 40 else font_small)
+    return image.quantize(palette=palette).rotate(90, expand=True)
+
+def composed_frame(compositor: Compositor, plot: Image, version: int,
+        track: str) -> Image:
+    """Frame rendered through the compositor"""
+    for name, (text, size, fill) in TEXT.items():
+        if name == 'track':
+            text = track
+        compositor.set_text(name, text, size, fill)
+    compositor.set_image('forecast', plot, version, (-20, 0))
+    return compositor.frame()
+
+def compare(plot: Image, palette: Image) -> int:
+    """Print pixels differing from the legacy frame
+    Returns:
+        int: differing pixels of the 'rgb' mode frame
+    """
+    legacy = legacy_frame(plot, palette).tobytes()
+    differ_rgb = 0
+    for mode in (Compositor.ModeRGB, Compositor.ModeNative):
+        frame = composed_frame(Compositor(mode=mode), plot, 0,
+                               TEXT['track'][0]).tobytes()
+        if mode == Compositor.ModeNative:
+            # legacy palette repeats black, white, red
+            differ = sum(1 for old, new in zip(legacy, frame) if old % 3 != new)
+        else:
+            differ = differ_rgb = sum(1 for old, new in zip(legacy, frame)
+                                      if old != new)
+        print(f"{mode} vs legacy: {differ} of {len(legacy)} pixels differ")
+    return differ_rgb
+
+def measure(label: str, repeat: int, func) -> None:
+    """Print mean wall time of func"""
+    start = time.perf_counter()
+    for i in range(repeat):
+        func(i)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<34} {elapsed / repeat * 1000:8.2f} ms")
+
+def main():
+    """main wrapper"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--repeat", type=int, default=20,
+                        help="frames per measurement")
+    parser.add_argument("--check", action="store_true",
+                        help="only compare output with the legacy frame")
+    args = parser.parse_args()
+
+    plot = forecast_image()
+    palette = Image.open('palette_bwr_bodge.bmp')
+    palette.load()
+    if args.check:
+        sys.exit(1 if compare(plot, palette) else 0)
+    measure("legacy (draw+quantize+rotate)", args.repeat,
+            lambda i: legacy_frame(plot, palette))
+    for mode in (Compositor.ModeRGB, Compositor.ModeNative):
+        compositor = Compositor(mode=mode)
+        measure(f"{mode}: every layer changed", args.repeat,
+                lambda i, c=compositor: composed_frame(c, plot, i, str(i)))
+        measure(f"{mode}: track changed", args.repeat,
+                lambda i, c=compositor: composed_frame(c, plot, -1, str(i)))
+    compare(plot, palette)
+
+if __name__ == "__main__":
+    main()
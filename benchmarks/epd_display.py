@@ -0,0 +1,41 @@
+# epd_display.py
+"""Measure CPU time and panel I/O of Epd.display on the simulated backend
+"""
+import argparse
+import time
+
+from PIL import Image
+
+from classes import epdconfig
+from classes.epd7in5b import Epd
+
+def main():
+    """main wrapper"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--repeat", type=int, default=10,
+                        help="number of refreshes")
+    args = parser.parse_args()
+
+    sim = epdconfig.select_backend('sim', sleep=False)
+    epd = Epd()
+    image = Image.new('P', (Epd.Width, Epd.Height), 1)
+    image.paste(0, (0, 0, Epd.Width // 2, Epd.Height))
+    image.paste(2, (0, 0, Epd.Width, Epd.Height // 4))
+    sim.reset()
+
+    start = time.process_time()
+    for _ in range(args.repeat):
+        epd.display(image, force=True)
+    elapsed = time.process_time() - start
+
+    print(f"display: {elapsed / args.repeat * 1000:.2f} ms CPU per refresh")
+    for key, value in sorted(sim.stats().items()):
+        print(f"{key}: {value / args.repeat:g} per refresh")
+
+    start = time.process_time()
+    epd.display(image)
+    print(f"unchanged frame: {(time.process_time() - start) * 1000:.2f} ms CPU")
+    print(f"epd: {epd.stats()}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+# forecast_plot.py
+"""Compare forecast plot renderers: render time and peak memory
+
+Every backend runs in its own interpreter so import cost and peak RSS are
+not shared, e.g. `python -m benchmarks.forecast_plot --save /tmp`.
+"""
+import argparse
+import math
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+
+def sample_forecast(start: int = None) -> dict:
+    """OpenWeatherMap 5 day / 3 hour forecast shaped payload"""
+    if start is None:
+        start = int(time.time()) // 10800 * 10800 + 10800
+    day = start // 86400 * 86400
+    samples = []
+    for index in range(40):
+        timestamp = start + index * 10800
+        sample = {
+            'dt': timestamp,
+            'main': {'temp': 273.15 + 5 + 6 * math.sin(index / 8 * math.pi)},
+        }
+        if 10 <= index < 16:
+            sample['rain'] = {'3h': 0.4 * (index - 9)}
+        if index == 30:
+            sample['snow'] = {'3h': 0.8}
+        samples.append(sample)
+    return {
+        'list': samples,
+        'city': {'sunrise': day + 6 * 3600, 'sunset': day + 16 * 3600},
+    }
+
+def offline_weather(plot_backend: str):
+    """OpenWeatherMap instance fed with `sample_forecast`"""
+    # pylint: disable=import-outside-toplevel
+    from classes.open_weather_map import OpenWeatherMap
+
+    class OfflineOpenWeatherMap(OpenWeatherMap):
+        """OpenWeatherMap without network"""
+        def _get_json_from_url(self, url, timeout=10):
+            return sample_forecast()
+
+    return OfflineOpenWeatherMap('Nowhere,xx', 'token', plot_backend)
+
+def run(backend: str, repeat: int, save: str) -> None:
+    """Measure one backend in this interpreter"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    weather = offline_weather(backend)
+    image = weather.plot()
+    first = time.perf_counter() - start
+    _, first_peak = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        # new plot cache key every time, so each call really renders
+        weather.sunset += 1
+        image = weather.plot()
+    steady = (time.perf_counter() - start) / repeat
+    _, steady_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        weather.plot()
+    cached = (time.perf_counter() - start) / repeat
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{backend:<11} first {first * 1000:8.1f} ms "
+          f"(incl. import, peak {first_peak / 2**20:6.2f} MiB)  "
+          f"steady {steady * 1000:7.1f} ms (peak {steady_peak / 2**20:6.2f} MiB)  "
+          f"max RSS {rss:6.1f} MiB  cached {cached * 1000:.3f} ms")
+    if save:
+        image.save(f"{save}/forecast_{backend}.png")
+
+def main():
+    """main wrapper"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-b", "--backend", type=str,
+                        help="run single backend in this process")
+    parser.add_argument("-n", "--repeat", type=int, default=10,
+                        help="renders per measurement")
+    parser.add_argument("--save", type=str,
+                        help="directory to save rendered plots into")
+    args = parser.parse_args()
+
+    if args.backend:
+        run(args.backend, args.repeat, args.save)
+        return
+    for backend in ('matplotlib', 'pil'):
+        command = [sys.executable, '-m', 'benchmarks.forecast_plot',
+                   '-b', backend, '-n', str(args.repeat)]
+        if args.save:
+            command += ['--save', args.save]
+        subprocess.run(command, check=True)
+
+if __name__ == "__main__":
+    main()
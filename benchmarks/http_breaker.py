@@ -0,0 +1,64 @@
+# http_breaker.py
+"""Check that every way a request ends settles the host's circuit breaker
+
+Runs offline against a stub session, exits with status 1 if a half-open
+probe slot is left taken, e.g. `python -m benchmarks.http_breaker`.
+"""
+import sys
+
+import requests
+
+from classes.circuit_breaker import CircuitBreaker
+from classes.json_from_api import JSONFromAPI
+
+HOST = 'http://breaker.invalid'
+
+class StubSession(requests.Session):
+    """Session raising queued exceptions, then answering 200"""
+    def __init__(self, errors: list):
+        super().__init__()
+        self.errors = list(errors)
+        self.calls = 0
+
+    def get(self, url, **kwargs): #pylint: disable=arguments-differ
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        response = requests.Response()
+        response.status_code = 200
+        response._content = b'{}' #pylint: disable=protected-access
+        return response
+
+def probe(error: Exception) -> bool:
+    """Trip breaker, fail the probe with error, then ask again"""
+    JSONFromAPI.configure_http(retries=0, failure_threshold=1,
+                               reset_timeout=0.0)
+    api = JSONFromAPI()
+    _, _, breaker = api._session(HOST) #pylint: disable=protected-access
+    session = StubSession([requests.exceptions.ConnectionError(), error])
+    JSONFromAPI._sessions[HOST] = session #pylint: disable=protected-access
+    api._request(HOST) #pylint: disable=protected-access
+    try:
+        api._request(HOST) #pylint: disable=protected-access
+    except Exception: #pylint: disable=broad-except
+        pass
+    healthy = api._request(HOST) is not None #pylint: disable=protected-access
+    print(f"{type(error).__name__:<24} calls {session.calls}  "
+          f"state {breaker.state:<9}  later request "
+          f"{'ok' if healthy else 'SKIPPED'}")
+    return healthy and breaker.state == CircuitBreaker.Closed
+
+def main():
+    """main wrapper"""
+    errors = [
+        requests.exceptions.ChunkedEncodingError(),
+        requests.exceptions.ContentDecodingError(),
+        requests.exceptions.TooManyRedirects(),
+        # not a requests error at all
+        ValueError(),
+    ]
+    results = [probe(error) for error in errors]
+    sys.exit(0 if all(results) else 1)
+
+if __name__ == "__main__":
+    main()
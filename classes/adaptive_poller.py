@@ -0,0 +1,184 @@
+# adaptive_poller.py
+"""This module polls a data provider at an interval adapted to its data
+"""
+import collections
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+from apscheduler.schedulers.base import BaseScheduler
+from classes import job_chain
+from classes.json_from_api import JSONFromAPI
+
+DAY = 86400
+
+class AdaptivePoller:
+    """This class runs a provider update as a self-rescheduling job
+
+    After each run the next one is scheduled:
+    - values moving by more than `fast_change` (relative) halve the
+      interval, values moving less than `slow_change` stretch it by half,
+    - `alert` changing (e.g. PM2.5 crossing its limit) drops the interval
+      to `min_interval`, while it holds the interval stays at most
+      `interval`,
+    - with a daily `quota`, the interval never spends requests faster than
+      the quota allows, and twice slower once less than a fifth of it is
+      left in the last 24 hours.
+    The interval always stays within [`min_interval`, `max_interval`].
+    """
+    def __init__(self, name: str, update: object, args: list,
+            measure: object, interval: float, min_interval: float,
+            max_interval: float, quota: int = None, hosts: list = None,
+            alert: object = None, fast_change: float = 0.2,
+            slow_change: float = 0.05):
+        """Class constructor
+        Args:
+            name (str): job name
+            update (callable): provider update, returns True on success
+            args (list): `update` arguments
+            measure (callable): returns tuple of values telling whether the
+                                data changed, numbers are compared relatively
+            interval (float): base interval (in seconds)
+            min_interval (float): shortest interval (in seconds)
+            max_interval (float): longest interval (in seconds)
+            quota (int, optional): requests allowed per day
+            hosts (:list:`str`, optional): hosts the quota counts requests to
+            alert (callable, optional): returns True in a state needing
+                                        frequent updates
+            fast_change (float, optional): relative change shortening interval
+            slow_change (float, optional): relative change stretching interval
+        """
+        self.logger = logging.getLogger(type(self).__name__)
+        self.name = name
+        self.__update = update
+        self.__args = args
+        self.__measure = measure
+        self.__alert = alert
+        self.__base_interval = interval
+        self.__min_interval = min_interval
+        self.__max_interval = max_interval
+        self.__quota = quota
+        self.__hosts = hosts or []
+        self.__fast_change = fast_change
+        self.__slow_change = slow_change
+        self.__lock = threading.Lock()
+        # (time, requests) per run within the last day
+        self.__requests = collections.deque()
+        self.__last = measure()
+        self.__last_alert = alert() if alert is not None else False
+        # requests counted so far, requests finishing after a run (e.g.
+        # hedged ones) are counted with the next run
+        self.__counted = self.__request_count()
+        self.interval = interval
+        self.runs = 0
+        self.failures = 0
+        self.useful = 0
+        self.request_total = 0
+        self.next_run = None
+        self.logger.debug('Class initialized')
+
+    def start(self, scheduler: BaseScheduler, first_run: datetime) -> None:
+        """Schedule first run
+        Args:
+            scheduler (BaseScheduler): scheduler running the job
+            first_run (datetime): when to run first
+        """
+        self.next_run = first_run
+        job_chain.chain(scheduler, self.name, self.run, first_run,
+                        self.__next_run)
+
+    def __next_run(self) -> datetime:
+        self.next_run = datetime.now() + timedelta(seconds=self.interval)
+        self.logger.info("%s: next update in %.0f s", self.name, self.interval)
+        return self.next_run
+
+    def __request_count(self) -> int:
+        return sum(JSONFromAPI.request_count(host) for host in self.__hosts)
+
+    def run(self) -> None:
+        """Run update and adapt the interval"""
+        success = False
+        try:
+            success = self.__update(*self.__args)
+        finally:
+            with self.__lock:
+                counted = self.__request_count()
+                self.__account(success, counted - self.__counted)
+                self.__counted = counted
+
+    def __account(self, success: bool, requests: int) -> None:
+        """Update counters and interval after a run"""
+        now = time.time()
+        self.runs += 1
+        self.request_total += requests
+        self.__requests.append((now, requests))
+        while self.__requests and self.__requests[0][0] < now - DAY:
+            self.__requests.popleft()
+        if not success:
+            self.failures += 1
+            return
+
+        values = self.__measure()
+        change = self.__change(self.__last, values)
+        self.__last = values
+        if change > 0:
+            self.useful += 1
+        interval = self.interval
+        if change > self.__fast_change:
+            interval /= 2
+        elif change < self.__slow_change:
+            interval *= 1.5
+        if self.__alert is not None:
+            alert = self.__alert()
+            if alert != self.__last_alert:
+                interval = self.__min_interval
+            elif alert:
+                interval = min(interval, self.__base_interval)
+            self.__last_alert = alert
+        self.interval = min(max(self.__quota_interval(interval),
+                                self.__min_interval),
+                            self.__max_interval)
+
+    def __quota_interval(self, interval: float) -> float:
+        """Stretch interval so requests stay within daily quota"""
+        if not self.__quota or not self.__requests:
+            return interval
+        per_run = (sum(requests for _, requests in self.__requests)
+                   / len(self.__requests))
+        # interval spending the whole quota evenly over a day
+        paced = DAY * per_run / self.__quota
+        left = self.__quota - sum(requests for _, requests in self.__requests)
+        if left < self.__quota / 5:
+            paced *= 2
+        return max(interval, paced)
+
+    @staticmethod
+    def __change(old: tuple, new: tuple) -> float:
+        """Largest relative change, 1.0 for changed non-numeric values"""
+        change = 0.0
+        for old_value, new_value in zip(old, new):
+            if old_value == new_value:
+                continue
+            if (isinstance(old_value, (int, float))
+                    and isinstance(new_value, (int, float))):
+                change = max(change, abs(new_value - old_value)
+                             / max(abs(old_value), 1e-9))
+            else:
+                change = 1.0
+        return change
+
+    def stats(self) -> dict:
+        """Interval, requests made and useful updates"""
+        with self.__lock:
+            return {
+                'interval': self.interval,
+                'next_run': (self.next_run.isoformat(timespec='seconds')
+                             if self.next_run is not None else None),
+                'runs': self.runs,
+                'failures': self.failures,
+                'useful_updates': self.useful,
+                'requests': self.request_total,
+                'requests_24h': sum(requests for _, requests in self.__requests),
+                'quota': self.__quota,
+            }
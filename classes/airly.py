@@ -1,26 +1,72 @@
 # airly.py
 """This module queries Airly.eu and provides retrieved data
 """
+import concurrent.futures
 import logging
 import inspect
 import multiprocessing
-#from datetime import datetime
+import statistics
+import threading
+import time
+from datetime import datetime
 
 from classes.json_from_api import JSONFromAPI
 
+# reading field -> Airly measurement name
+Values = {
+    'pm001': 'PM1',
+    'pm025': 'PM25',
+    'pm100': 'PM10',
+    'press': 'PRESSURE',
+    'humi': 'HUMIDITY',
+    'temp': 'TEMPERATURE',
+}
+# reading field -> Airly standard pollutant
+Limits = {
+    'pm025_limit': 'PM25',
+    'pm100_limit': 'PM10',
+}
+# EU daily limits, used when the provider has none
+EULimits = {
+    'pm025_limit': 25.0,
+    'pm100_limit': 50.0,
+}
+# sensor.community value type -> attribute
+SensorCommunityValues = {
+    'P1': 'pm100',
+    'P2': 'pm025',
+    'temperature': 'temp',
+    'humidity': 'humi',
+}
+
 class Airly(JSONFromAPI):
     """This class queries Airly.eu and provides retrieved data
+
+    All installations are queried at once. In 'hedged' mode the first
+    valid reading is used, in 'aggregate' mode the per-value median of all
+    valid readings.
     """
-    def __init__(self, location_list, token):
+    # shared by all installations, not a timeout each
+    UpdateBudget = 30.0
+    ModeHedged = 'hedged'
+    ModeAggregate = 'aggregate'
+    def __init__(self, location_list, token, mode=ModeHedged):
         """Class constructor
         Args:
             location (:list:`str`): forecast location, 'City,xx', xx = country code
             token (str): API token
+            mode (str, optional): 'hedged' or 'aggregate'
         """
         super().__init__()
         self.logger = logging.getLogger(type(self).__name__)
         self.__location_list = location_list
         self.__token = token
+        self.mode = mode
+        self.__executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(len(location_list.get('airly', [])), 1),
+            thread_name_prefix='airly')
+        self.__stations = {}
+        self.__stations_lock = threading.Lock()
         self.pm100 = 0.0
         self.pm025 = 0.0
         self.pm001 = 0.0
@@ -30,83 +76,214 @@ class Airly(JSONFromAPI):
         self.press = 1000.0
         self.humi = 50.0
         self._updated = False
-        self.__update()
+        snapshot = self._load_snapshot()
+        # True: state comes from the snapshot, not fetched yet
+        self.restored = snapshot is not None
+        if self.restored:
+            for field in list(Values) + list(Limits):
+                setattr(self, field, snapshot.get(field, getattr(self, field)))
+        else:
+            with self.deadline(self.UpdateBudget):
+                self.__update()
         self.logger.debug('Class initialized')
 
     def __update(self) -> bool:
         """Update smog data"""
         for service in self.__location_list.keys():
             if service == "airly":
-                for location in self.__location_list[service]:
-                    tmp_url = (
-                        "https://airapi.airly.eu/v2/measurements/installation"
-                        + "?apikey="
-                        + self.__token
-                        + "&installationId="
-                        + location
-                        )
-                    tmp_json = self._get_json_from_url(tmp_url)
-                    if tmp_json is None:
-                        continue
-                    if tmp_json['current']['indexes'][0]['value'] is None:
-                        continue
-                    self.logger.info(location)
-                    self.pm100 = tmp_json['current']['values'][2]['value']
-                    self.pm025 = tmp_json['current']['values'][1]['value']
-                    self.pm001 = tmp_json['current']['values'][0]['value']
-                    self.pm100_limit = tmp_json['current']['standards'][1]['limit']
-                    self.pm025_limit = tmp_json['current']['standards'][0]['limit']
-                    self.temp = tmp_json['current']['values'][5]['value']
-                    self.press = tmp_json['current']['values'][3]['value']
-                    self.humi = tmp_json['current']['values'][4]['value']
-                    self._updated = True
-
-                    return True
+                if self.__update_airly(self.__location_list[service]):
+                    break
 
             if service == "sensor_community":
-                continue
-                #TODO alternative provider
-                #for location in self.__location_list[service]:
-                #    retry = False
-                #    sensors = ['P1', 'P2', 'temperature', 'humidity']
-                #    tmp_url = (
-                #        "https://data.sensor.community/airrohr/v1/sensor/"
-                #        + location
-                #        + "/"
-                #        )
-                #    tmp_json = self._get_json_from_url(tmp_url, timeout=60)
-                #    tmp_json = sorted(tmp_json,
-                #        cmp=self.__sensor_community_sort,
-                #        key=lambda x:x['timestamp'])
-                #    for sdv in tmp_json[0]['sensordatavalues']:
-                #        for sensor in sensors:
-                #            if sensor not in sdv.values():
-                #                retry = True
-                #                continue
+                if self.__update_sensor_community(self.__location_list[service]):
+                    break
+        else:
+            self.logger.error('update not successful')
+            return False
 
-        self.logger.error('update not successful')
-        return False
+        self._save_snapshot({field: getattr(self, field)
+                             for field in list(Values) + list(Limits)})
+        return True
+
+    def __update_airly(self, locations: list) -> bool:
+        """Query all installations concurrently
+        Args:
+            locations (:list:`str`): installation IDs
+        Returns:
+            bool: True if a valid reading was applied
+        """
+        until = self.remaining_until()
+        futures = [self.__executor.submit(self.__fetch, location, until)
+                   for location in locations]
+        timeout = None if until is None else max(until - time.monotonic(), 0)
+        readings = []
+        try:
+            for future in concurrent.futures.as_completed(futures, timeout):
+                reading = future.result()
+                if reading is None:
+                    continue
+                readings.append(reading)
+                if self.mode == self.ModeHedged:
+                    # slower installations finish in background, stats only
+                    break
+        except concurrent.futures.TimeoutError:
+            self.logger.warning("installations not answering in time")
+        if not readings:
+            return False
+        if self.mode == self.ModeAggregate:
+            reading = {field: statistics.median(
+                           [reading[field] for reading in readings
+                            if reading[field] is not None] or [None])
+                       for field in Values}
+            reading.update({field: readings[0][field] for field in Limits})
+        else:
+            reading = readings[0]
+        with self.__stations_lock:
+            for used in readings:
+                self.__stations[used['location']]['used'] += 1
+        for field in list(Values) + list(Limits):
+            if reading[field] is not None:
+                setattr(self, field, reading[field])
+        self._updated = True
+        return True
+
+    def __fetch(self, location: str, until: float) -> dict:
+        """Query one installation, runs in the executor
+        Args:
+            location (str): installation ID
+            until (float): deadline of the update, `time.monotonic()`
+        Returns:
+            dict: reading, None if unavailable
+        """
+        tmp_url = (
+            "https://airapi.airly.eu/v2/measurements/installation"
+            + "?apikey="
+            + self.__token
+            + "&installationId="
+            + location
+            )
+        start = time.monotonic()
+        with self.deadline(until=until):
+            tmp_json = self._get_json_from_url(tmp_url)
+        latency = time.monotonic() - start
+        reading = None
+        if (tmp_json is not None
+                and tmp_json['current']['indexes'][0]['value'] is not None):
+            current = tmp_json['current']
+            values = {value['name']: value['value']
+                      for value in current['values']}
+            limits = {standard['pollutant']: standard['limit']
+                      for standard in current['standards']}
+            reading = {field: values.get(name) for field, name in Values.items()}
+            reading.update({field: limits.get(name)
+                            for field, name in Limits.items()})
+            reading['location'] = location
+            self.logger.info(location)
+        measured = None
+        if reading is not None and current.get('tillDateTime'):
+            measured = datetime.fromisoformat(
+                current['tillDateTime'].replace('Z', '+00:00')).timestamp()
+        self.__record(location, latency, reading is not None, measured)
+        return reading
+
+    def __update_sensor_community(self, sensors: list) -> bool:
+        """Query sensor.community sensors
+        A sensor's feed is an array of its readings from the last minutes,
+        streamed and reduced to the newest value of each type.
+        Args:
+            sensors (:list:`str`): sensor IDs, e.g. a PM and a climate sensor
+        Returns:
+            bool: True if PM10 and PM2.5 were found
+        """
+        newest = {}
+        for sensor in sensors:
+            tmp_url = (
+                "https://data.sensor.community/airrohr/v1/sensor/"
+                + sensor
+                + "/"
+                )
+            start = time.monotonic()
+            found = {}
+            for reading in self._iter_json_array_from_url(tmp_url, timeout=60):
+                # 'YYYY-MM-DD HH:MM:SS' UTC, compares as text
+                timestamp = reading.get('timestamp', '')
+                for value in reading.get('sensordatavalues', []):
+                    value_type = value.get('value_type')
+                    if (value_type in SensorCommunityValues
+                            and timestamp > found.get(value_type, ('',))[0]):
+                        found[value_type] = (timestamp, value.get('value'))
+            measured = None
+            if found:
+                measured = datetime.fromisoformat(
+                    max(found.values())[0] + '+00:00').timestamp()
+            self.__record('sensor_community/' + sensor,
+                          time.monotonic() - start, bool(found), measured)
+            for value_type, value in found.items():
+                if value[0] > newest.get(value_type, ('',))[0]:
+                    newest[value_type] = value
+        if 'P1' not in newest or 'P2' not in newest:
+            return False
+        for value_type, (_, value) in newest.items():
+            try:
+                setattr(self, SensorCommunityValues[value_type], float(value))
+            except (TypeError, ValueError):
+                self.logger.warning("invalid %s value: %s", value_type, value)
+        # sensor.community has no limits, keep Airly's or use EU norms
+        self.pm100_limit = self.pm100_limit or EULimits['pm100_limit']
+        self.pm025_limit = self.pm025_limit or EULimits['pm025_limit']
+        self._updated = True
+        return True
+
+    def __record(self, location: str, latency: float, valid: bool,
+            measured: float) -> None:
+        """Update station counters"""
+        with self.__stations_lock:
+            station = self.__stations.setdefault(location, {
+                'ok': 0, 'failed': 0, 'used': 0, 'latency': None,
+                'measured': None})
+            station['latency'] = latency
+            if valid:
+                station['ok'] += 1
+            else:
+                station['failed'] += 1
+            if measured is not None:
+                station['measured'] = measured
+
+    def station_stats(self) -> dict:
+        """Per-installation counters, last latency and age of the reading"""
+        with self.__stations_lock:
+            return {location: dict(
+                        {key: value for key, value in station.items()
+                         if key != 'measured'},
+                        age=(time.time() - station['measured']
+                             if station['measured'] is not None else None))
+                    for location, station in self.__stations.items()}
 
     def update(self, producer_arl: multiprocessing.connection.Connection) -> bool:
         """Update and send smog data"""
-        ret = self.__update()
+        with self.deadline(self.UpdateBudget):
+            ret = self.__update()
         if ret:
-            producer_arl.send({
-                'pm100': self.pm100,
-                'pm025': self.pm025,
-                'pm001': self.pm001,
-                'pm100_limit': self.pm100_limit,
-                'pm025_limit': self.pm025_limit,
-                'temp': self.temp,
-                'press': self.press,
-                'humi': self.humi,
-                'updated': self._updated,
-                'is_air_ok': self.is_air_ok()
-            })
-            self.logger.info("sent data via pipe")
-            return True
+            return self.send(producer_arl)
         return False
 
+    def send(self, producer_arl: multiprocessing.connection.Connection) -> bool:
+        """Send current smog data"""
+        producer_arl.send({
+            'pm100': self.pm100,
+            'pm025': self.pm025,
+            'pm001': self.pm001,
+            'pm100_limit': self.pm100_limit,
+            'pm025_limit': self.pm025_limit,
+            'temp': self.temp,
+            'press': self.press,
+            'humi': self.humi,
+            'updated': self._updated,
+            'is_air_ok': self.is_air_ok()
+        })
+        self.logger.info("sent data via pipe")
+        return True
+
     def is_air_ok(self) -> bool:
         """Check if smog is within EU norms
         Returns:
@@ -122,8 +299,3 @@ class Airly(JSONFromAPI):
                               str(inspect.currentframe().f_back.f_lineno))
             status = False
         return status
-
-    #def __sensor_community_sort(self, left, right):
-    #    left_time = datetime.strptime(left,'%Y-%m-%d %H:%M:%S')
-    #    right_time = datetime.strptime(right,'%Y-%m-%d %H:%M:%S')
-    #    return 1 if left_time > right_time  else -1 if left_time < right_time else 0
@@ -3,11 +3,32 @@
 """
 import logging
 import multiprocessing
+import time
+from datetime import datetime, timedelta
+
+from apscheduler.schedulers.base import BaseScheduler
+from classes import job_chain
 from classes.json_from_api import JSONFromAPI
+from classes.playlist_index import PlaylistIndex
 
 class CRoJazz(JSONFromAPI):
     """This class queries croapi.cz and provides retrieved data
+
+    The day's playlist is fetched in bulk and indexed, the current track is
+    looked up locally and the next update runs right after the current
+    track ends. The now-playing endpoint is only asked when the index does
+    not know the current track or when it ends, and every
+    `ReconcileInterval` to check it.
     """
+    UpdateBudget = 15.0
+    # seconds after a track boundary before updating, lets the API catch up
+    BoundarySlack = 5.0
+    # update interval when no track boundary is known
+    PollInterval = 60.0
+    # the now-playing endpoint is checked at least this often
+    ReconcileInterval = 900.0
+    # a track with unknown end is assumed to be over after this
+    MaxTrackSeconds = 1200.0
     def __init__(self):
         """Class constructor
         """
@@ -16,12 +37,55 @@ class CRoJazz(JSONFromAPI):
         self.track_artist = "N/A"
         self.track_title = "N/A"
         self._updated = False
-        self.__update()
+        self.__index = None
+        self.__index_fetched = 0.0
+        self.__reconciled = 0.0
+        self.__now_till = None
+        # (artist, title) from the last now-playing request, None if it failed
+        self.__now_track = None
+        self.next_update = None
+        self.index_hits = 0
+        self.index_refreshes = 0
+        self.now_requests = 0
+        self.mismatches = 0
+        snapshot = self._load_snapshot()
+        # True: state comes from the snapshot, not fetched yet
+        self.restored = snapshot is not None
+        if self.restored:
+            self.track_artist = snapshot['track_artist']
+            self.track_title = snapshot['track_title']
+        else:
+            self.__update()
         self.logger.debug('Class initialized')
 
     def update(self, croj: multiprocessing.connection.Connection):
         """update"""
-        self.__update()
+        now = time.time()
+        self._updated = False
+        if ((self.__index is None or not self.__index.covers(now))
+                and now - self.__index_fetched >= self.PollInterval):
+            self.__refresh_index(now)
+        track = self.__index.at(now) if self.__index is not None else None
+        if track is not None and self.__index.end_estimated(now):
+            # the index cannot tell when this track ends, ask as before
+            track = None
+        if track is None or now - self.__reconciled >= self.ReconcileInterval:
+            self.__update()
+            self.__reconciled = now
+            # a failed request keeps the previous track, not a disagreement
+            if (track is not None and self.__now_track is not None
+                    and track != self.__now_track):
+                self.logger.warning("playlist index disagrees with now playing")
+                self.mismatches += 1
+                self.__index = None
+        else:
+            self.index_hits += 1
+            self.__set_track(*track)
+        self.next_update = self.__next_update(now)
+        return self.send(croj)
+
+    def send(self, croj: multiprocessing.connection.Connection) -> bool:
+        """send current data via pipe"""
         croj.send({
             'track_artist': self.track_artist,
             'track_title': self.track_title,
@@ -30,25 +94,92 @@ class CRoJazz(JSONFromAPI):
         self.logger.info("sent data via pipe")
         return True
 
+    def schedule_updates(self, scheduler: BaseScheduler,
+            croj: multiprocessing.connection.Connection,
+            first_run: datetime) -> None:
+        """Run `update` at first_run, then at each `next_update`"""
+        job_chain.chain(
+            scheduler, 'cro_jazz', lambda: self.update(croj), first_run,
+            lambda: self.next_update or datetime.now() + timedelta(
+                seconds=self.PollInterval))
+
+    def __next_update(self, now: float) -> datetime:
+        """Right after the current track, at least every `ReconcileInterval`"""
+        boundary = None
+        if self.__index is not None and not self.__index.end_estimated(now):
+            boundary = self.__index.next_boundary(now)
+        if boundary is None and self.__now_till is not None and self.__now_till > now:
+            boundary = self.__now_till
+        if boundary is None:
+            when = now + self.PollInterval
+        else:
+            when = min(boundary + self.BoundarySlack,
+                       self.__reconciled + self.ReconcileInterval)
+        return datetime.fromtimestamp(max(when, now + 1))
+
+    def __refresh_index(self, now: float) -> None:
+        """Fetch and index today's playlist"""
+        self.__index_fetched = now
+        day = datetime.fromtimestamp(now)
+        tmp_url = ("https://croapi.cz/data/v2/playlist/day/"
+                   + day.strftime('%Y/%m/%d') + "/jazz.json")
+        with self.deadline(self.UpdateBudget):
+            tmp_json = self._get_json_from_url(tmp_url)
+        if tmp_json is None or not isinstance(tmp_json.get('data'), list):
+            self.logger.warning("day playlist unavailable")
+            return
+        self.__index = PlaylistIndex(tmp_json['data'], self.MaxTrackSeconds)
+        self.index_refreshes += 1
+        self.logger.info("playlist indexed, %i tracks", len(self.__index))
+
+    def stats(self) -> dict:
+        """Index use and now-playing requests"""
+        return {
+            'index_hits': self.index_hits,
+            'index_refreshes': self.index_refreshes,
+            'indexed_tracks': len(self.__index) if self.__index is not None else 0,
+            'now_requests': self.now_requests,
+            'mismatches': self.mismatches,
+            'next_update': (self.next_update.isoformat(timespec='seconds')
+                            if self.next_update is not None else None),
+        }
+
+    def __set_track(self, artist: str, title: str) -> None:
+        if artist != self.track_artist:
+            self.track_artist = artist
+            self._updated = True
+        if title != self.track_title:
+            self.track_title = title
+            self._updated = True
+        if self._updated:
+            self._save_snapshot({
+                'track_artist': self.track_artist,
+                'track_title': self.track_title,
+            })
+
     def __update(self) -> bool:
         """Update programme data"""
         self._updated = False
+        self.now_requests += 1
+        self.__now_track = None
         tmp_url = "https://croapi.cz/data/v2/playlist/now/jazz.json"
-        tmp_json = self._get_json_from_url(tmp_url)
+        with self.deadline(self.UpdateBudget):
+            # asked right when a track ends, a cached answer is the old track
+            tmp_json = self._get_json_from_url(tmp_url, heuristic=False)
         if tmp_json is None:
             return False
 
-        tmp_string = (
+        self.__set_track(
             tmp_json['data']['interpret'] if 'interpret' in tmp_json['data']
-            else "N\\A")
-        if tmp_string != self.track_artist:
-            self.track_artist = tmp_string
-            self._updated = True
-        tmp_string = (
+            else "N\\A",
             tmp_json['data']['track'] if 'track' in tmp_json['data']
             else "N\\A")
-        if tmp_string != self.track_title:
-            self.track_title = tmp_string
-            self._updated = True
+        self.__now_track = (self.track_artist, self.track_title)
+        try:
+            self.__now_till = (datetime.fromisoformat(
+                tmp_json['data']['till']).timestamp()
+                if tmp_json['data'].get('till') else None)
+        except (TypeError, ValueError):
+            self.__now_till = None
 
         return self._updated
@@ -0,0 +1,107 @@
+# circuit_breaker.py
+"""This module stops calling an upstream that keeps failing
+"""
+import logging
+import threading
+import time
+
+class CircuitBreaker:
+    """This class tracks failures of one upstream
+
+    Closed: requests pass, consecutive failures are counted. After
+    `failure_threshold` failures the breaker opens and requests fail fast.
+    After `reset_timeout` seconds it becomes half-open and lets
+    `half_open_max` probe requests through; a successful probe closes it,
+    a failed one opens it again.
+    """
+    Closed = 'closed'
+    Open = 'open'
+    HalfOpen = 'half_open'
+
+    def __init__(self, name: str, failure_threshold: int = 5,
+            reset_timeout: float = 60.0, half_open_max: int = 1):
+        """Class constructor
+        Args:
+            name (str): upstream name, for logs
+            failure_threshold (int, optional): consecutive failures to open
+            reset_timeout (float, optional): seconds open before probing
+            half_open_max (int, optional): concurrent probes when half-open
+        """
+        self.logger = logging.getLogger(type(self).__name__)
+        self.name = name
+        self.__failure_threshold = failure_threshold
+        self.__reset_timeout = reset_timeout
+        self.__half_open_max = half_open_max
+        self.__lock = threading.Lock()
+        self.__state = self.Closed
+        self.__failures = 0
+        self.__opened_at = 0.0
+        self.__probes = 0
+        self.trips = 0
+        self.short_circuits = 0
+        self.logger.debug('Class initialized')
+
+    @property
+    def state(self) -> str:
+        """Current state, open turns half-open once `reset_timeout` passed"""
+        with self.__lock:
+            return self.__current_state()
+
+    def __current_state(self) -> str:
+        if (self.__state == self.Open
+                and time.monotonic() - self.__opened_at >= self.__reset_timeout):
+            self.__state = self.HalfOpen
+            self.__probes = 0
+        return self.__state
+
+    def allow(self) -> bool:
+        """Check whether a request may be sent
+        Returns:
+            bool: True if allowed, the outcome must then be recorded with
+                  `success` or `failure`
+        """
+        with self.__lock:
+            state = self.__current_state()
+            if state == self.Closed:
+                return True
+            if state == self.HalfOpen and self.__probes < self.__half_open_max:
+                self.__probes += 1
+                return True
+            self.short_circuits += 1
+            return False
+
+    def success(self) -> None:
+        """Record successful request"""
+        with self.__lock:
+            if self.__state != self.Closed:
+                self.logger.warning("%s: circuit closed", self.name)
+            self.__state = self.Closed
+            self.__failures = 0
+
+    def failure(self) -> None:
+        """Record failed request"""
+        with self.__lock:
+            self.__failures += 1
+            if (self.__state == self.HalfOpen
+                    or self.__failures >= self.__failure_threshold):
+                if self.__state != self.Open:
+                    self.logger.warning("%s: circuit open for %.0f s",
+                                        self.name, self.__reset_timeout)
+                    self.trips += 1
+                self.__state = self.Open
+                self.__opened_at = time.monotonic()
+
+    def release(self) -> None:
+        """Record allowed request ending without outcome, e.g. cut short
+        by the caller's deadline; frees its probe slot when half-open"""
+        with self.__lock:
+            if self.__state == self.HalfOpen and self.__probes > 0:
+                self.__probes -= 1
+
+    def stats(self) -> dict:
+        """State and counters"""
+        return {
+            'state': self.state,
+            'trips': self.trips,
+            'short_circuits': self.short_circuits,
+        }
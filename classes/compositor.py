@@ -0,0 +1,248 @@
+# compositor.py
+"""This module composes e-ink frames from cached widget layers
+"""
+import logging
+
+from PIL import Image, ImageDraw, ImageFont
+
+class GlyphCache:
+    """This class keeps fonts and rasterized glyphs between frames
+    """
+    def __init__(self, font_path: str):
+        """Class constructor
+        Args:
+            font_path (str): TrueType font file
+        """
+        self.logger = logging.getLogger(type(self).__name__)
+        self.__font_path = font_path
+        self.__fonts = {}
+        self.__glyphs = {}
+        self.__threshold = [0] * 128 + [255] * 128
+        self.hits = 0
+        self.misses = 0
+        self.logger.debug('Class initialized')
+
+    def font(self, size: int) -> ImageFont.FreeTypeFont:
+        """Get font of given size, loading it on first use"""
+        if size not in self.__fonts:
+            self.__fonts[size] = ImageFont.truetype(self.__font_path, size)
+        return self.__fonts[size]
+
+    def glyph(self, char: str, size: int, binary: bool = False) -> tuple:
+        """Get rasterized glyph
+        Args:
+            char (str): single character
+            size (int): font size
+            binary (bool, optional): threshold the antialiased mask to 0/255,
+                                     for palette images where blending indices
+                                     makes no sense
+        Returns:
+            tuple: ('L' mask or None, (x, y) mask offset, advance)
+        """
+        key = (char, size, binary)
+        if key in self.__glyphs:
+            self.hits += 1
+            return self.__glyphs[key]
+        self.misses += 1
+        font = self.font(size)
+        left, top, right, bottom = font.getbbox(char)
+        mask = None
+        if right > left and bottom > top:
+            mask = Image.new('L', (right - left, bottom - top), 0)
+            ImageDraw.Draw(mask).text((-left, -top), char, font=font, fill=255)
+            if binary:
+                mask = mask.point(self.__threshold)
+        self.__glyphs[key] = (mask, (left, top), font.getlength(char))
+        return self.__glyphs[key]
+
+    def draw_text(self, image: Image, position: tuple, text: str, size: int,
+            fill, binary: bool = False) -> None:
+        """Draw single line of text from cached glyphs
+        Args:
+            image (PIL.Image): target image
+            position (tuple): (x, y) of the text origin, as in ImageDraw.text
+            text (str): text to draw
+            size (int): font size
+            fill: colour in the mode of `image`
+            binary (bool, optional): use thresholded glyphs
+        """
+        cursor = float(position[0])
+        for char in text:
+            mask, offset, advance = self.glyph(char, size, binary)
+            if mask is not None:
+                left = round(cursor) + offset[0]
+                top = position[1] + offset[1]
+                image.paste(fill, (left, top, left + mask.width,
+                                   top + mask.height), mask)
+            cursor += advance
+
+class Compositor:
+    """This class keeps each e-ink widget as a cached layer and redraws only
+    layers whose input changed
+
+    In 'rgb' mode layers are drawn in RGB on a portrait canvas, and the frame
+    is quantized against the palette BMP and rotated for the panel. In
+    'native' mode layers are drawn as palette indices and pasted, rotated, into
+    a 'P' canvas in panel orientation, so the canvas is the frame.
+    """
+    Width = 384
+    Height = 640
+    Background = (0xFF, 0xFF, 0xFF)
+
+    ModeRGB = "rgb"
+    ModeNative = "native"
+    # RGB colour -> panel palette index, see Epd.ColorLookupPalette3
+    NativeColors = {
+        (0x00, 0x00, 0x00): 0,
+        (0xFF, 0xFF, 0xFF): 1,
+        (0xFF, 0x00, 0x00): 2,
+    }
+
+    # text widgets top to bottom: (name, font size, least height); a band
+    # grows to the font's ascent + descent, so no glyph is clipped
+    TextLayers = (
+        ('date', 40, 61),
+        ('track', 12, 16),
+        ('smog', 12, 16),
+        ('temperature', 12, 16),
+    )
+    # widget -> (left, top, right, bottom) in portrait orientation
+    ImageLayers = {
+        'forecast': (0, 430, 384, 630),
+    }
+    TextOffset = (10, 0)
+
+    def __init__(self, font_path: str = 'SourceCodePro-Regular.ttf',
+            palette_path: str = 'palette_bwr_bodge.bmp', mode: str = ModeRGB):
+        """Class constructor
+        Args:
+            font_path (str, optional): TrueType font file
+            palette_path (str, optional): image holding the panel palette
+            mode (str, optional): 'rgb' or 'native'
+        """
+        self.logger = logging.getLogger(type(self).__name__)
+        self.mode = mode
+        self.glyphs = GlyphCache(font_path)
+        self.__palette = Image.open(palette_path)
+        self.__palette.load()
+        # widget -> (left, top, right, bottom) in portrait orientation
+        self.layers = {}
+        self.__text_sizes = {}
+        top = 0
+        for name, size, height in self.TextLayers:
+            ascent, descent = self.glyphs.font(size).getmetrics()
+            bottom = top + max(height, ascent + descent)
+            self.layers[name] = (0, top, self.Width, bottom)
+            self.__text_sizes[name] = size
+            top = bottom
+        self.layers.update(self.ImageLayers)
+        if self.mode == self.ModeNative:
+            self.__canvas = self.__native_image((self.Height, self.Width))
+        else:
+            self.__canvas = Image.new('RGB', (self.Width, self.Height),
+                                      self.Background)
+        self.__keys = {}
+        self.__frame = None
+        self.renders = {name: 0 for name in self.layers}
+        self.reuses = {name: 0 for name in self.layers}
+        self.logger.debug('Class initialized')
+
+    def __layer(self, name: str, key) -> Image:
+        """Get blank layer image, or None if `key` did not change"""
+        if name in self.__keys and self.__keys[name] == key:
+            self.reuses[name] += 1
+            return None
+        self.__keys[name] = key
+        self.renders[name] += 1
+        self.__frame = None
+        left, top, right, bottom = self.layers[name]
+        if self.mode == self.ModeNative:
+            return self.__native_image((right - left, bottom - top))
+        return Image.new('RGB', (right - left, bottom - top), self.Background)
+
+    def __native_image(self, size: tuple) -> Image:
+        image = Image.new('P', size, self.NativeColors[self.Background])
+        image.putpalette([channel for color in self.NativeColors
+                          for channel in color])
+        return image
+
+    def __commit(self, name: str, layer: Image) -> None:
+        left, top, right, _ = self.layers[name]
+        if self.mode == self.ModeNative:
+            # portrait (x, y) lands on panel (y, Width - 1 - x)
+            self.__canvas.paste(layer.transpose(Image.Transpose.ROTATE_90),
+                                (top, self.Width - right))
+            return
+        self.__canvas.paste(layer, (left, top))
+
+    def set_text(self, name: str, text: str, size: int = None,
+            fill: tuple = (0, 0, 0)) -> bool:
+        """Set text widget
+        Args:
+            name (str): layer name
+            text (str): text line, empty to blank the layer
+            size (int, optional): font size, the band is sized for the
+                                  layer's size in `TextLayers` (default)
+            fill (tuple, optional): RGB colour
+        Returns:
+            bool: True if the layer was re-rasterized
+        """
+        if size is None:
+            size = self.__text_sizes[name]
+        layer = self.__layer(name, (text, size, fill))
+        if layer is None:
+            return False
+        if self.mode == self.ModeNative:
+            self.glyphs.draw_text(layer, self.TextOffset, text, size,
+                                  self.NativeColors[fill], binary=True)
+        else:
+            self.glyphs.draw_text(layer, self.TextOffset, text, size, fill)
+        self.__commit(name, layer)
+        return True
+
+    def set_image(self, name: str, image: Image, key,
+            offset: tuple = (0, 0)) -> bool:
+        """Set image widget
+        Args:
+            name (str): layer name
+            image (PIL.Image): image to paste into the layer
+            key: identifies the image content, layer is redrawn when it changes
+            offset (tuple, optional): image position relative to the layer
+        Returns:
+            bool: True if the layer was re-rasterized
+        """
+        layer = self.__layer(name, key)
+        if layer is None:
+            return False
+        if self.mode == self.ModeNative:
+            # only the visible part is quantized, straight to panel indices
+            left, top, right, bottom = self.layers[name]
+            image = image.crop((-offset[0], -offset[1],
+                                right - left - offset[0],
+                                bottom - top - offset[1]))
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            image = image.quantize(palette=self.__palette)
+            offset = (0, 0)
+        layer.paste(image, offset)
+        self.__commit(name, layer)
+        return True
+
+    def frame(self) -> Image:
+        """Get panel frame: palette image in panel orientation"""
+        if self.mode == self.ModeNative:
+            return self.__canvas
+        if self.__frame is None:
+            # sanitize image palette
+            self.__frame = self.__canvas.quantize(
+                palette=self.__palette).rotate(90, expand=True)
+        return self.__frame
+
+    def stats(self) -> dict:
+        """Layer and glyph cache counters"""
+        return {
+            'renders': dict(self.renders),
+            'reuses': dict(self.reuses),
+            'glyph_hits': self.glyphs.hits,
+            'glyph_misses': self.glyphs.misses,
+        }
@@ -1,114 +1,174 @@
 # eink.py
 """This module wraps e-ink update funcion
 """
-from datetime import datetime
+from datetime import datetime, timedelta
 import json
 import logging
 import multiprocessing
+import multiprocessing.connection
 import time
 
-from PIL import Image, ImageDraw, ImageFont
-
+from classes.compositor import Compositor
 from classes.epd7in5b import Epd
+from classes.shared_raster import SharedRasterReader, SharedRasterWriter
 
 __logger = logging.getLogger(__name__)
 
+def __seconds_to_midnight() -> float:
+    now = datetime.now()
+    midnight = datetime.combine(now.date() + timedelta(days=1),
+                                datetime.min.time())
+    return (midnight - now).total_seconds()
+
+def __render(epd: Epd, compositor: Compositor, cro_jazz: dict,
+        smog_airly: dict, forecast: dict, rasters: SharedRasterReader,
+        flag_radio_playing: multiprocessing.sharedctypes.SynchronizedBase) -> bool:
+    compositor.set_text('date', datetime.now().strftime('%Y-%m-%d'), 40)
+
+    text_line = ''
+    if bool(flag_radio_playing):
+        text_line = ('ČRoJazz: ' + cro_jazz['track_artist'] + " - "
+                    + cro_jazz['track_title'])
+    compositor.set_text('track', text_line)
+
+    text_line = ('Smog:    ' + str(smog_airly['pm001']) + "/"
+                + str(smog_airly['pm025']) + "/"
+                + str(smog_airly['pm100']))
+    dust_string_color = (0, 0, 0) if smog_airly['is_air_ok'] else (255, 0, 0)
+    compositor.set_text('smog', text_line, fill=dust_string_color)
+
+    text_line = 'Temp:    '+str(smog_airly['temp'])+"°"
+    compositor.set_text('temperature', text_line)
+
+    image = rasters.attach(forecast)
+    if image is not None:
+        compositor.set_image('forecast', image,
+                             (forecast['shm'], forecast['version']), (-20, 0))
+    if image is None or not rasters.current(forecast):
+        # slot reused by a newer plot, its message is on the way
+        __logger.warning("forecast plot replaced while rendering, skipped")
+        return False
+
+    if epd.display(compositor.frame()):
+        __logger.info("display updated")
+    __logger.info("e-ink stats: %s", epd.stats())
+    __logger.info("compositor stats: %s", compositor.stats())
+    return True
+
+def __publish_preview(producer_preview: multiprocessing.connection.Connection,
+        frames: SharedRasterWriter, epd: Epd, compositor: Compositor,
+        forecast: dict, publish_frame: bool) -> None:
+    preview = {
+        'digest': epd.frame_digest,
+        'forecast': forecast,
+        'stats': {'epd': epd.stats(), 'compositor': compositor.stats()},
+    }
+    if publish_frame:
+        preview['frame'] = frames.publish(compositor.frame())
+    producer_preview.send(preview)
+
 #process
 def update_eink(consumer_cro: multiprocessing.connection.Connection,
         consumer_opw: multiprocessing.connection.Connection,
         consumer_arl: multiprocessing.connection.Connection,
         producer_tcplog: multiprocessing.connection.Connection,
-        flag_radio_playing: multiprocessing.sharedctypes.SynchronizedBase) -> None:
-    """update e-ink display"""
+        flag_radio_playing: multiprocessing.sharedctypes.SynchronizedBase,
+        coalesce_window: float = 2.0,
+        min_refresh_interval: float = 60.0,
+        render_mode: str = Compositor.ModeNative,
+        producer_preview: multiprocessing.connection.Connection = None) -> None:
+    """update e-ink display
+
+    Sleeps in `multiprocessing.connection.wait` on all input pipes. The
+    first change schedules a refresh `coalesce_window` seconds later, so
+    updates arriving close together end up in one frame; refreshes are
+    never closer than `min_refresh_interval` seconds. Nothing is drawn
+    until every producer has reported once. `render_mode` is passed to
+    `Compositor`. If `producer_preview` is given, every frame sent to the
+    panel is published there as a shared memory descriptor, with its digest
+    and the render stats.
+    """
+    #pylint: disable-msg=too-many-branches
     epd = Epd()
     epd.clear("white")
-    startup_lock = True
+    compositor = Compositor(mode=render_mode)
+    rasters = SharedRasterReader()
+    frames = SharedRasterWriter()
+    published_digest = None
+    consumers = [consumer_cro, consumer_arl, consumer_opw]
+    cro_jazz = None
+    smog_airly = None
+    forecast = None
+    last_refresh = -min_refresh_interval
+    refresh_at = None
+    date = datetime.now().date()
     while True:
-        if startup_lock:
-            __logger.info("update_eink: waiting for cro")
-            while not consumer_cro.poll():
-                pass
-            __logger.info("update_eink: waiting for arl")
-            while not consumer_arl.poll():
-                pass
-            __logger.info("update_eink: waiting for opw")
-            while not consumer_opw.poll():
-                pass
-            startup_lock = False
+        if refresh_at is not None:
+            timeout = max(0.0, refresh_at - time.monotonic())
+        else:
+            timeout = __seconds_to_midnight()
+        ready = multiprocessing.connection.wait(consumers, timeout)
 
         update_display = False
+        for consumer in ready:
+            try:
+                # only the newest message matters
+                while consumer.poll():
+                    message = consumer.recv()
+            except EOFError:
+                __logger.error("update_eink: producer pipe closed")
+                consumers.remove(consumer)
+                continue
 
-        if consumer_cro.poll():
-            # here assing cro data
-            while consumer_cro.poll():
-                cro_jazz = consumer_cro.recv()
-            if cro_jazz['updated']:
-                update_display = True
-            __logger.info('from pipe: %s', cro_jazz)
-        # those are updated infrequently, no point spamming APIs
-        if consumer_arl.poll():
-            # here assing cro data
-            smog_airly = consumer_arl.recv()
-            __logger.info('from pipe: %s', smog_airly)
-            if smog_airly['updated']:
+            if consumer is consumer_cro:
+                if cro_jazz is None or message['updated']:
+                    update_display = True
+                cro_jazz = message
+                __logger.info('from pipe: %s', cro_jazz)
+            if consumer is consumer_arl:
+                if smog_airly is None:
+                    update_display = True
+                smog_airly = message
+                __logger.info('from pipe: %s', smog_airly)
+                if smog_airly['updated']:
+                    update_display = True
+                    smog_json = json.dumps({
+                            "severity": "notice",
+                            "pm10_outside": smog_airly['pm001'],
+                            "pm25_outside": smog_airly['pm025'],
+                            "pm100_outside": smog_airly['pm100'],
+                            "temp_outside": smog_airly['temp'],
+                            "humi_outside": smog_airly['humi'],
+                            "press_outside": smog_airly['press']
+                        }) + '\n'
+                    __logger.info("update_eink: producing")
+                    producer_tcplog.send(smog_json)
+            if consumer is consumer_opw:
+                forecast = message['plot']
+                __logger.info('from pipe: image %s', forecast)
                 update_display = True
-            if smog_airly['updated']:
-                smog_json = json.dumps({
-                        "severity": "notice",
-                        "pm10_outside": smog_airly['pm001'],
-                        "pm25_outside": smog_airly['pm025'],
-                        "pm100_outside": smog_airly['pm100'],
-                        "temp_outside": smog_airly['temp'],
-                        "humi_outside": smog_airly['humi'],
-                        "press_outside": smog_airly['press']
-                    }) + '\n'
-                __logger.info("update_eink: producing")
-                producer_tcplog.send(smog_json)
-            update_display = True
 
-        if consumer_opw.poll():
-            forecast_plot_image = consumer_opw.recv()['plot']
-            __logger.info('from pipe: image')
+        if datetime.now().date() != date:
+            date = datetime.now().date()
             update_display = True
 
-        if update_display:
-
-            framebuffer_font_big = ImageFont.truetype(
-                'SourceCodePro-Regular.ttf', 40)
-            framebuffer_font_small = ImageFont.truetype(
-                'SourceCodePro-Regular.ttf', 12)
-
-            framebuffer_image = Image.new('RGB', (384, 640), (0xFF, 0xFF, 0xFF))
-            framebuffer_image.paste(forecast_plot_image, (-20, 430))
-            framebuffer_draw = ImageDraw.Draw(framebuffer_image)
-            framebuffer_draw.text((10, 0),
-                                datetime.now().strftime('%Y-%m-%d'),
-                                font=framebuffer_font_big, fill=0)
-
-            if bool(flag_radio_playing):
-                top_offset = 45
-                text_line = ('ČRoJazz: ' + cro_jazz['track_artist'] + " - "
-                            + cro_jazz['track_title'])
-                framebuffer_draw.text((10, top_offset+16), text_line,
-                                    font=framebuffer_font_small, fill=0)
-
-            text_line = ('Smog:    ' + str(smog_airly['pm001']) + "/"
-                        + str(smog_airly['pm025']) + "/"
-                        + str(smog_airly['pm100']))
-
-            dust_string_color = (0, 0, 0) if smog_airly['is_air_ok'] else (255, 0, 0)
-            framebuffer_draw.text((10, top_offset+16*2), text_line,
-                                font=framebuffer_font_small,
-                                fill=dust_string_color)
-            text_line = 'Temp:    '+str(smog_airly['temp'])+"°"
-            framebuffer_draw.text((10, top_offset+16*3), text_line,
-                                font=framebuffer_font_small, fill=0)
-
-            # sanitize image palette
-            framebuffer_image = framebuffer_image.quantize(
-                palette=Image.open('palette_bwr_bodge.bmp'))
-
-            framebuffer_image = framebuffer_image.rotate(90, expand=True)
-            epd.display(framebuffer_image)
-            __logger.info("display updated")
-        time.sleep(60)
+        if update_display and refresh_at is None:
+            refresh_at = max(time.monotonic() + coalesce_window,
+                             last_refresh + min_refresh_interval)
+
+        if refresh_at is None or time.monotonic() < refresh_at:
+            continue
+        if cro_jazz is None or smog_airly is None or forecast is None:
+            __logger.info("update_eink: waiting for all producers")
+            refresh_at = None
+            continue
+
+        refresh_at = None
+        last_refresh = time.monotonic()
+        if not __render(epd, compositor, cro_jazz, smog_airly, forecast,
+                        rasters, flag_radio_playing):
+            continue
+        if producer_preview is not None:
+            __publish_preview(producer_preview, frames, epd, compositor,
+                              forecast, epd.frame_digest != published_digest)
+            published_digest = epd.frame_digest
@@ -48,11 +48,16 @@
 #
 """This module drives e-ink display"""
 
+import hashlib
 import logging
+import time
 import PIL
-from RPi import GPIO
 from classes import epdconfig
 
+def _pack_table(lookup: dict, shift: int) -> bytes:
+    """Build `bytes.translate` table mapping palette index to panel nibble"""
+    return bytes(lookup[index % len(lookup)] << shift for index in range(256))
+
 class Epd:
     """e-ink display representation"""
     # Display resolution
@@ -98,6 +103,18 @@ class Epd:
     ReadVcomValue                              = 0x81
     VcmDcSetting                               = 0x82
 
+    # longest BUSY wait before the panel is considered wedged
+    BusyTimeoutMs = 60000
+
+    # reset pulse: cold start after power up, warm wake from DeepSleep
+    ResetColdMs = 200
+    ResetWarmMs = 10
+
+    # power states
+    StateOff = "off"
+    StateActive = "active"
+    StateSleep = "sleep"
+
     ColorLookupNamed = { "black": 0b000,
                          "grey1": 0b001,
                          "grey2": 0b010,
@@ -121,41 +138,101 @@ class Epd:
                             2: 0b100
                             }
 
-    def __init__(self):
+    # palette index -> panel nibble, for the first and second pixel of each
+    # byte; indices > 2 wrap around the same way `_pxmap` does
+    _PackTableHigh = _pack_table(ColorLookupPalette3, 4)
+    _PackTableLow = _pack_table(ColorLookupPalette3, 0)
+
+    def __init__(self, power_save: bool = True):
+        """Class constructor
+        Args:
+            power_save (bool, optional): put panel into DeepSleep after each
+                                         refresh, wake it for the next one
+        """
         self.logger = logging.getLogger(type(self).__name__)
+        self.power_save = power_save
         self.reset_pin = epdconfig.RST_PIN
         self.dc_pin = epdconfig.DC_PIN
+        # digest of the framebuffer currently shown, None if unknown
+        self._panel_digest = None
+        # hex digest of the last framebuffer passed to the panel
+        self.frame_digest = None
+        self._stats = {
+            'refreshes': 0,
+            'skipped': 0,
+            'refresh_seconds': 0.0,
+            'pack_seconds': 0.0,
+            'busy_waits': 0,
+            'busy_timeouts': 0,
+            'busy_wait_seconds': 0.0,
+            'busy_wait_max_seconds': 0.0,
+            'wakeups': 0,
+            'wake_seconds': 0.0,
+            'state_seconds': {
+                self.StateOff: 0.0,
+                self.StateActive: 0.0,
+                self.StateSleep: 0.0,
+            },
+        }
+        self._state = self.StateOff
+        self._state_since = time.monotonic()
         self._init()
         self.logger.debug('Class initialized')
 
-    def reset(self):
+    def reset(self, delay: int = ResetColdMs):
         """Hardware reset"""
-        # epdconfig.digital_write(self.reset_pin, GPIO.HIGH)
+        # epdconfig.digital_write(self.reset_pin, epdconfig.HIGH)
         # epdconfig.delay_ms(200)
-        epdconfig.digital_write(self.reset_pin, GPIO.LOW)         # module reset
-        epdconfig.delay_ms(200)
-        epdconfig.digital_write(self.reset_pin, GPIO.HIGH)
-        epdconfig.delay_ms(200)
+        epdconfig.digital_write(self.reset_pin, epdconfig.LOW)         # module reset
+        epdconfig.delay_ms(delay)
+        epdconfig.digital_write(self.reset_pin, epdconfig.HIGH)
+        epdconfig.delay_ms(delay)
+
+    def _set_state(self, state: str):
+        now = time.monotonic()
+        self._stats['state_seconds'][self._state] += now - self._state_since
+        self._state = state
+        self._state_since = now
 
     def _send_command(self, command):
-        epdconfig.digital_write(self.dc_pin, GPIO.LOW)
+        epdconfig.digital_write(self.dc_pin, epdconfig.LOW)
         epdconfig.spi_writebyte([command])
 
     def _send_data(self, data):
-        epdconfig.digital_write(self.dc_pin, GPIO.HIGH)
+        epdconfig.digital_write(self.dc_pin, epdconfig.HIGH)
         epdconfig.spi_writebyte([data])
 
-    def _wait_until_idle(self):
+    def _send_data_bulk(self, data: bytes):
+        """Send whole buffer with DC held high"""
+        epdconfig.digital_write(self.dc_pin, epdconfig.HIGH)
+        epdconfig.spi_writebytes(data)
+
+    def _wait_until_idle(self, timeout_ms: int = None) -> bool:
         self.logger.info("e-Paper busy")
-        while epdconfig.digital_read() == 0:     # 0: busy, 1: idle
-            epdconfig.delay_ms(100)
-        self.logger.info("e-Paper busy release")
+        start = time.monotonic()
+        idle = epdconfig.wait_for_idle(timeout_ms or self.BusyTimeoutMs)
+        waited = time.monotonic() - start
+        self._stats['busy_waits'] += 1
+        self._stats['busy_wait_seconds'] += waited
+        self._stats['busy_wait_max_seconds'] = max(
+            self._stats['busy_wait_max_seconds'], waited)
+        if not idle:
+            self._stats['busy_timeouts'] += 1
+            self.logger.error("e-Paper still busy after %.1f s", waited)
+            return False
+        self.logger.info("e-Paper busy release after %.3f s", waited)
+        return True
 
-    def _init(self):
-        if epdconfig.module_init() != 0:
+    def _init(self, warm: bool = False):
+        """Power up panel
+        Args:
+            warm (bool, optional): waking from DeepSleep, GPIO/SPI is already
+                                   set up and a short reset pulse is enough
+        """
+        if not warm and epdconfig.module_init() != 0:
             return -1
 
-        self.reset()
+        self.reset(self.ResetWarmMs if warm else self.ResetColdMs)
 
         self._send_command(self.PowerSetting)
         self._send_data(0x37)
@@ -187,6 +264,7 @@ class Epd:
         self._send_command(0xe5)           #FLASH MODE
         self._send_data(0x03)
 
+        self._set_state(self.StateActive)
         return 0
 
     def _pxmap(self, pixel):
@@ -201,46 +279,101 @@ class Epd:
     def _pxmap8(self, pixel):
         return self.ColorLookupPalette8[pixel]
 
-    def display(self, image: PIL.Image) -> None:
-        """Display image"""
+    def pack(self, image: PIL.Image) -> bytes:
+        """Pack palette image into 4bpp panel framebuffer
+        Args:
+            image (PIL.Image): 'P' or 'L' image, pixel values are palette
+                               indices
+        Returns:
+            bytes: two pixels per byte, first pixel in the high nibble
+        """
+        pixels = image.tobytes()
+        if len(pixels) % 2:
+            pixels += b'\x00'
+        if max(pixels) > 2:
+            self.logger.warning("image color palette > 3, converting anyway")
+        high = pixels[0::2].translate(self._PackTableHigh)
+        low = pixels[1::2].translate(self._PackTableLow)
+        # nibbles do not overlap, so a single big-int OR merges both halves
+        return (int.from_bytes(high, 'big')
+                | int.from_bytes(low, 'big')).to_bytes(len(high), 'big')
+
+    def display(self, image: PIL.Image, force: bool = False) -> bool:
+        """Display image, unless the panel already shows it
+        Args:
+            image (PIL.Image): palette image, Width x Height
+            force (bool, optional): refresh even if the content is unchanged
+        Returns:
+            bool: True if the panel was refreshed
+        """
         if image.height != self.Height or image.width != self.Width:
             self.logger.error("cannot display image of incorrect size")
             self.logger.info("%s != %s or %s != %s",
                 image.height, self.Height, image.width, self.Width)
-            return
-        self._send_command(self.DataStartTransmission1)
-        imagedata = iter(list(image.getdata()))
-        for pixel in imagedata:
-            byte = self._pxmap(pixel)
-            byte = byte << 4
-            pixel = next(imagedata, 0)
-            byte = byte | self._pxmap(pixel)
-            self._send_data(byte)
-
-        self._send_command(self.DisplayRefresh)
-        epdconfig.delay_ms(100)
-        self._wait_until_idle()
+            return False
+        start = time.monotonic()
+        framebuffer = self.pack(image)
+        self._stats['pack_seconds'] += time.monotonic() - start
+        return self._refresh(framebuffer, force)
 
     def clear(self, color: str = "white") -> None:
         """Display solid color"""
         if color not in self.ColorLookupNamed:
             self.logger.error("unknown color")
             return
-        self._send_command(self.DataStartTransmission1)
         byte = self.ColorLookupNamed[color]
         byte = byte << 4
         byte = byte | self.ColorLookupNamed[color]
-        for _ in range(0, self.Width // 8 * self.Height):
-            self._send_data(byte)
-            self._send_data(byte)
-            self._send_data(byte)
-            self._send_data(byte)
+        self._refresh(bytes([byte]) * (self.Width // 2 * self.Height), True)
+
+    def stats(self) -> dict:
+        """Refresh and power counters since construction"""
+        stats = dict(self._stats)
+        stats['state'] = self._state
+        stats['state_seconds'] = dict(self._stats['state_seconds'])
+        stats['state_seconds'][self._state] += (time.monotonic()
+                                                - self._state_since)
+        return stats
+
+    def _wake(self):
+        if self._state == self.StateActive:
+            return
+        start = time.monotonic()
+        self._init(warm=self._state == self.StateSleep)
+        self._stats['wakeups'] += 1
+        self._stats['wake_seconds'] += time.monotonic() - start
+
+    def _refresh(self, framebuffer: bytes, force: bool) -> bool:
+        digest = hashlib.blake2b(framebuffer, digest_size=16).digest()
+        self.frame_digest = digest.hex()
+        if digest == self._panel_digest and not force:
+            self._stats['skipped'] += 1
+            self.logger.info("frame unchanged, refresh skipped (%i skipped, "
+                "%i refreshed)", self._stats['skipped'],
+                self._stats['refreshes'])
+            return False
+        self._wake()
+        start = time.monotonic()
+        self._send_command(self.DataStartTransmission1)
+        self._send_data_bulk(framebuffer)
         self._send_command(self.DisplayRefresh)
         epdconfig.delay_ms(100)
-        self._wait_until_idle()
+        if not self._wait_until_idle():
+            # content on the panel is unknown now, next frame goes out
+            # after a full cold init
+            self._panel_digest = None
+            self._set_state(self.StateOff)
+            return False
+        self._panel_digest = digest
+        self._stats['refreshes'] += 1
+        self._stats['refresh_seconds'] += time.monotonic() - start
+        if self.power_save:
+            self._sleep()
+        return True
 
     def _sleep(self):
         self._send_command(self.PowerOff)
         self._wait_until_idle()
         self._send_command(self.DeepSleep)
         self._send_data(0xA5)
+        self._set_state(self.StateSleep)
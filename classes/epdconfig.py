@@ -32,11 +32,18 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 #
-"""This module wraps e-ink display configuration"""
+"""This module wraps e-ink display configuration
 
+Hardware access goes through a backend: `rpi` drives the real panel through
+spidev/RPi.GPIO, `sim` keeps everything in memory and records the traffic.
+The backend is picked with `select_backend()` or the EPD_BACKEND environment
+variable, before the first call into this module.
+"""
+
+import collections
+import logging
+import os
 import time
-import spidev
-from RPi import GPIO
 
 # Pin definition
 RST_PIN         = 17
@@ -44,35 +51,225 @@ DC_PIN          = 25
 CS_PIN          = 8
 BUSY_PIN        = 24
 
-# SPI device, bus = 0, device = 0
-SPI = spidev.SpiDev(0, 0)
+# Pin levels, same values as RPi.GPIO.LOW/HIGH
+LOW             = 0
+HIGH            = 1
+
+# largest transfer spidev accepts in one ioctl (default bufsiz)
+SPI_CHUNK_SIZE  = 4096
+
+# BUSY level is re-checked this often while waiting for the edge, so a
+# rising edge lost before the wait started costs at most one slice
+EDGE_WAIT_SLICE_MS = 1000
+# polling interval when edge detection is not available
+POLL_INTERVAL_MS = 10
+
+__logger = logging.getLogger(__name__)
+
+class RpiBackend:
+    """Raspberry Pi GPIO/SPI backend"""
+    def __init__(self):
+        # pylint: disable=import-outside-toplevel
+        import spidev
+        from RPi import GPIO
+        self.gpio = GPIO
+        # SPI device, bus = 0, device = 0
+        self.spi = spidev.SpiDev(0, 0)
+
+    def digital_write(self, pin, value):
+        """Set GPIO pin"""
+        self.gpio.output(pin, value)
+
+    def digital_read(self):
+        """Get BUSY pin"""
+        return self.gpio.input(BUSY_PIN)
+
+    def delay_ms(self, delaytime):
+        """sleep function wrapper"""
+        time.sleep(delaytime / 1000.0)
+
+    def wait_for_idle(self, timeout_ms):
+        """Block until BUSY goes high
+        Args:
+            timeout_ms (int): give up after this many ms
+        Returns:
+            bool: True if idle, False on timeout
+        """
+        deadline = time.monotonic() + timeout_ms / 1000.0
+        while self.digital_read() == 0:     # 0: busy, 1: idle
+            remaining_ms = int((deadline - time.monotonic()) * 1000)
+            if remaining_ms <= 0:
+                return False
+            try:
+                self.gpio.wait_for_edge(BUSY_PIN, self.gpio.RISING,
+                    timeout=min(remaining_ms, EDGE_WAIT_SLICE_MS))
+            except RuntimeError:
+                # edge detection already in use or unsupported
+                time.sleep(min(remaining_ms, POLL_INTERVAL_MS) / 1000.0)
+        return True
+
+    def spi_write(self, data):
+        """write one SPI transfer"""
+        self.spi.writebytes2(data)
+
+    def module_init(self):
+        """Set up GPIO"""
+        self.gpio.setmode(self.gpio.BCM)
+        self.gpio.setwarnings(False)
+        self.gpio.setup(RST_PIN, self.gpio.OUT)
+        self.gpio.setup(DC_PIN, self.gpio.OUT)
+        self.gpio.setup(CS_PIN, self.gpio.OUT)
+        self.gpio.setup(BUSY_PIN, self.gpio.IN)
+        self.spi.max_speed_hz = 2000000
+        self.spi.mode = 0b00
+        return 0
+
+class SimulatedBackend:
+    """In-memory backend recording panel traffic
+
+    Bytes written with DC low are commands, bytes written with DC high are
+    data for the last command. Commands listed in `busy_ms` pull BUSY low
+    for the given time, like the panel does on power on/off and refresh.
+    """
+    def __init__(self, refresh_ms=0, power_ms=0, sleep=True, history=64):
+        """Class constructor
+        Args:
+            refresh_ms (int): BUSY time after DisplayRefresh
+            power_ms (int): BUSY time after PowerOn/PowerOff
+            sleep (bool): really sleep in `delay_ms`, otherwise only count
+            history (int): number of commands to keep in `transactions`
+        """
+        self.busy_ms = {0x02: power_ms, 0x04: power_ms, 0x12: refresh_ms}
+        self.sleep = sleep
+        self.pins = {}
+        self.busy_until = 0.0
+        self.transactions = collections.deque(maxlen=history)
+        self.counters = collections.Counter()
+
+    def digital_write(self, pin, value):
+        """Set GPIO pin"""
+        self.counters['gpio_writes'] += 1
+        if self.pins.get(pin) != value:
+            self.counters['gpio_toggles'] += 1
+        self.pins[pin] = value
+
+    def digital_read(self):
+        """Get BUSY pin"""
+        self.counters['gpio_reads'] += 1
+        return 0 if time.monotonic() < self.busy_until else 1
+
+    def delay_ms(self, delaytime):
+        """sleep function wrapper"""
+        self.counters['delay_ms'] += delaytime
+        if self.sleep:
+            time.sleep(delaytime / 1000.0)
+
+    def wait_for_idle(self, timeout_ms):
+        """Block until simulated BUSY goes high
+        Args:
+            timeout_ms (int): give up after this many ms
+        Returns:
+            bool: True if idle, False on timeout
+        """
+        self.counters['busy_waits'] += 1
+        busy_s = max(0.0, self.busy_until - time.monotonic())
+        idle = busy_s <= timeout_ms / 1000.0
+        if not idle:
+            busy_s = timeout_ms / 1000.0
+        if self.sleep:
+            time.sleep(busy_s)
+        else:
+            self.busy_until = 0.0
+        return idle
+
+    def spi_write(self, data):
+        """write one SPI transfer"""
+        self.counters['spi_calls'] += 1
+        self.counters['spi_bytes'] += len(data)
+        if self.pins.get(DC_PIN) == HIGH:
+            self.counters['data_bytes'] += len(data)
+            if not self.transactions:
+                self.transactions.append((None, bytearray()))
+            self.transactions[-1][1].extend(data)
+            return
+        for command in bytes(data):
+            self.counters['commands'] += 1
+            self.transactions.append((command, bytearray()))
+            if self.busy_ms.get(command):
+                self.busy_until = (time.monotonic()
+                                   + self.busy_ms[command] / 1000.0)
+
+    def module_init(self):
+        """Set up GPIO"""
+        self.counters['module_init'] += 1
+        return 0
+
+    def stats(self) -> dict:
+        """Transfer counters since construction or last `reset()`"""
+        return dict(self.counters)
+
+    def reset(self):
+        """Clear counters and recorded transactions"""
+        self.counters.clear()
+        self.transactions.clear()
+
+Backends = {
+    'rpi': RpiBackend,
+    'sim': SimulatedBackend,
+}
+
+_backend = None
+
+def select_backend(name: str = None, **kwargs):
+    """Create backend used by module functions
+    Args:
+        name (str, optional): 'rpi' or 'sim', defaults to EPD_BACKEND or 'rpi'
+        **kwargs: passed to backend constructor
+    Returns:
+        backend instance
+    """
+    global _backend # pylint: disable=global-statement
+    if name is None:
+        name = os.environ.get('EPD_BACKEND', 'rpi')
+    _backend = Backends[name](**kwargs)
+    __logger.debug("e-Paper backend: %s", name)
+    return _backend
+
+def backend():
+    """Get current backend, creating the default one on first use"""
+    if _backend is None:
+        return select_backend()
+    return _backend
 
 def digital_write(pin, value):
     """Set GPIO pin"""
-    GPIO.output(pin, value)
+    backend().digital_write(pin, value)
 
 def digital_read():
     """Get GPIO pin"""
-    return GPIO.input(BUSY_PIN)
+    return backend().digital_read()
 
 def delay_ms(delaytime):
     """sleep function wrapper"""
-    time.sleep(delaytime / 1000.0)
+    backend().delay_ms(delaytime)
+
+def wait_for_idle(timeout_ms):
+    """Block until BUSY goes high or timeout_ms passes, True if idle"""
+    return backend().wait_for_idle(timeout_ms)
 
 def spi_writebyte(data):
     """write to SPI"""
-    SPI.writebytes(data)
+    backend().spi_write(bytes(data))
+
+def spi_writebytes(data):
+    """write buffer to SPI in SPI_CHUNK_SIZE transfers"""
+    view = memoryview(data)
+    spi = backend()
+    for offset in range(0, len(view), SPI_CHUNK_SIZE):
+        spi.spi_write(view[offset:offset + SPI_CHUNK_SIZE])
 
 def module_init():
     """Set up GPIO"""
-    GPIO.setmode(GPIO.BCM)
-    GPIO.setwarnings(False)
-    GPIO.setup(RST_PIN, GPIO.OUT)
-    GPIO.setup(DC_PIN, GPIO.OUT)
-    GPIO.setup(CS_PIN, GPIO.OUT)
-    GPIO.setup(BUSY_PIN, GPIO.IN)
-    SPI.max_speed_hz = 2000000
-    SPI.mode = 0b00
-    return 0
+    return backend().module_init()
 
 ### END OF FILE ###
@@ -0,0 +1,75 @@
+# forecast_model.py
+"""This module keeps OpenWeatherMap forecast in columnar form
+"""
+import hashlib
+import math
+from array import array
+
+DAY = 86400
+
+class Forecast:
+    """This class keeps forecast samples as typed columns
+
+    Parsed once per fetch; the plot and any other consumer read the same
+    arrays.
+    """
+    def __init__(self, timestamps: array, temperature: array,
+            precipitation: array):
+        """Class constructor
+        Args:
+            timestamps (:array:`q`): UNIX timestamps of the samples
+            temperature (:array:`d`): temperature in °C
+            precipitation (:array:`d`): rain + snow in mm/3h
+        """
+        self.timestamps = timestamps
+        self.temperature = temperature
+        self.precipitation = precipitation
+
+    @classmethod
+    def from_json(cls, forecast_json: dict) -> 'Forecast':
+        """Parse 5 day / 3 hour forecast response
+        Args:
+            forecast_json (dict): OpenWeatherMap forecast response
+        Returns:
+            Forecast: parsed forecast
+        """
+        samples = forecast_json['list']
+        return cls(
+            array('q', [sample['dt'] for sample in samples]),
+            array('d', [sample['main']['temp'] - 273.15 for sample in samples]),
+            array('d', [sample.get('rain', {}).get('3h', 0)
+                        + sample.get('snow', {}).get('3h', 0)
+                        for sample in samples]))
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    def digest(self) -> bytes:
+        """Content digest of all columns"""
+        digest = hashlib.blake2b(digest_size=16)
+        for column in (self.timestamps, self.temperature, self.precipitation):
+            digest.update(column.tobytes())
+        return digest.digest()
+
+    def night_intervals(self, sunset: int, sunrise: int, days: int = 0) -> list:
+        """Project sunset and sunrise few days forward
+        Args:
+            sunset (int): today's sunset timestamp
+            sunrise (int): today's sunrise timestamp
+            days (int, optional): number of nights to project after tonight
+                                  (0 - as many as the forecast covers)
+        Returns:
+            :list:`list`: [sunset, sunrise] pairs clipped to the forecast
+        """
+        first, last = self.timestamps[0], self.timestamps[-1]
+        # night i lasts from sunset + i days to sunrise + (i + 1) days,
+        # stop at the first night reaching past the forecast
+        nights = min(math.floor((last - sunrise) / DAY),
+                     math.floor((last - sunset) / DAY) + 1)
+        nights = max(nights, 0)
+        if days:
+            nights = min(nights, days)
+        intervals = [[min(max(sunset + i * DAY, first), last),
+                      min(max(sunrise + (i + 1) * DAY, first), last)]
+                     for i in range(nights + 1)]
+        return [night for night in intervals if night[1] > night[0]]
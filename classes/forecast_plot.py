@@ -0,0 +1,314 @@
+# forecast_plot.py
+"""This module renders precipitation/temperature forecast plots
+
+Two renderers take the same arguments: `MatplotlibForecastFigure` keeps a
+persistent matplotlib figure, `plot_pil` draws a look-alike directly with PIL
+in the panel colours, without importing matplotlib at all.
+"""
+import functools
+import logging
+import math
+from datetime import datetime, timedelta
+
+from PIL import Image, ImageDraw, ImageFont
+
+class MatplotlibForecastFigure:
+    """This class keeps one matplotlib figure between renders
+
+    Axes, formatters and locators are set up once. Each render only moves
+    the data artists (precipitation line and area, temperature line, night
+    spans, midnight markers). While the axis limits stay the same the
+    rendered background is restored and only the data artists are blitted
+    over it; a full draw happens only when the limits change.
+    """
+    def __init__(self):
+        """Class constructor
+        """
+        self.logger = logging.getLogger(type(self).__name__)
+        self.__figure = None
+        self.__size = None
+        self.__limits = None
+        self.__background = None
+        # set up in __setup, matplotlib is imported on first render
+        self.__plot = None
+        self.__ax1 = None
+        self.__ax2 = None
+        self.__precipitation_line = None
+        self.__precipitation_fill = None
+        self.__temperature_line = None
+        self.__nights = []
+        self.__midnights = []
+        self.__date2num = None
+        self.full_draws = 0
+        self.blits = 0
+        self.logger.debug('Class initialized')
+
+    def __setup(self, x_resolution: int, y_resolution: int) -> None:
+        # pylint: disable=import-outside-toplevel
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plot
+        import matplotlib.dates as plotDates
+        self.__plot = plot
+
+        if self.__figure is not None:
+            plot.close(self.__figure)
+        self.__figure = plot.figure(figsize=(x_resolution/80,
+                                             y_resolution/80),
+                                    dpi=80)
+        self.__size = (x_resolution, y_resolution)
+        self.__limits = None
+
+        #plot precipitation
+        self.__ax1 = self.__figure.add_subplot(111)
+        self.__ax1.xaxis_date()
+        self.__precipitation_line, = self.__ax1.plot([], [], color='black',
+                                                     animated=True)
+        self.__precipitation_fill = self.__ax1.fill_between(
+            [0, 1], 0, [0, 0], color='black', animated=True)
+
+        #plot temperatures
+        self.__ax2 = self.__ax1.twinx()
+        self.__ax2.yaxis.tick_left()
+        self.__temperature_line, = self.__ax2.plot([], [], color='red',
+                                                   animated=True)
+        self.__ax2.xaxis.set_major_formatter(plotDates.DateFormatter('%H'))
+        self.__ax2.xaxis.set_major_locator(
+            plotDates.HourLocator(byhour=range(0, 24, 6)))
+
+        #grid lines for temperatures
+        self.__ax2.grid(True, 'major', 'y', color="black")
+
+        self.__ax1.xaxis.set_minor_formatter(plotDates.DateFormatter('%a'))
+        self.__ax1.xaxis.set_minor_locator(plotDates.HourLocator(byhour=11))
+        self.__ax1.tick_params(axis='x', which='minor', top=False,
+                               labeltop=True, bottom=False, labelbottom=False)
+        self.__ax1.yaxis.tick_right()
+
+        # night spans and midnight markers, reused between renders
+        self.__nights = []
+        self.__midnights = []
+        self.__date2num = plotDates.date2num
+
+    def __night(self, index: int):
+        if index == len(self.__nights):
+            # pylint: disable=import-outside-toplevel
+            from matplotlib.patches import Rectangle
+            self.__nights.append(self.__ax2.add_patch(Rectangle(
+                (0, 0), 0, 1, transform=self.__ax2.get_xaxis_transform(),
+                facecolor="none", edgecolor="black", hatch='....',
+                animated=True)))
+        return self.__nights[index]
+
+    def __midnight(self, index: int):
+        if index == len(self.__midnights):
+            self.__midnights.append(self.__ax2.axvline(
+                x=0, ls=':', color="red", animated=True))
+        return self.__midnights[index]
+
+    def __call__(self, timestamps: list, temperature: list,
+            precipitation: list, nights: list, x_resolution: int,
+            y_resolution: int) -> Image:
+        """Render forecast with matplotlib
+        Args:
+            timestamps (:list:`int`): UNIX timestamps of the samples
+            temperature (:list:`float`): temperature in °C
+            precipitation (:list:`float`): rain + snow in mm/3h
+            nights (:list:`list`): [sunset, sunrise] timestamp pairs
+            x_resolution (int): horizontal length in pixels
+            y_resolution (int): vertical length in pixels
+        Returns:
+            PIL.Image: RGB image containing the plot
+        """
+        #pylint: disable-msg=too-many-locals
+        if self.__size != (x_resolution, y_resolution):
+            self.__setup(x_resolution, y_resolution)
+
+        x_axis_hours = [datetime.fromtimestamp(timestamp)
+                        for timestamp in timestamps]
+        x_axis = self.__date2num(x_axis_hours)
+        self.__precipitation_line.set_data(x_axis, precipitation)
+        self.__precipitation_fill.set_verts([
+            [(x_axis[0], 0)] + list(zip(x_axis, precipitation))
+            + [(x_axis[-1], 0)]])
+        self.__temperature_line.set_data(x_axis, temperature)
+
+        #mark nights
+        for index, night_timestamp in enumerate(nights):
+            night = self.__night(index)
+            start, end = self.__date2num([
+                datetime.fromtimestamp(night_timestamp[0]),
+                datetime.fromtimestamp(night_timestamp[1])])
+            night.set_x(start)
+            night.set_width(end - start)
+            night.set_visible(True)
+        for night in self.__nights[len(nights):]:
+            night.set_visible(False)
+
+        midnights = [x_axis_hour - timedelta(hours=1)
+                     for x_axis_hour in x_axis_hours if x_axis_hour.hour == 1]
+        for index, midnight in enumerate(self.__date2num(midnights)):
+            line = self.__midnight(index)
+            line.set_xdata([midnight, midnight])
+            line.set_visible(True)
+        for line in self.__midnights[len(midnights):]:
+            line.set_visible(False)
+
+        #limits: no x margins, precipitation from 0, 5 % y margins otherwise
+        temperature_margin = (max(temperature) - min(temperature)) * 0.05 or 1
+        limits = (
+            (x_axis[0], x_axis[-1]),
+            (0, max(precipitation) * 1.05 or 1),
+            (min(temperature) - temperature_margin,
+             max(temperature) + temperature_margin),
+        )
+        forecast_canvas = self.__figure.canvas
+        if limits != self.__limits:
+            self.__ax1.set_xlim(*limits[0])
+            self.__ax1.set_ylim(*limits[1])
+            self.__ax2.set_ylim(*limits[2])
+            # animated artists are left out, what is drawn is the background
+            forecast_canvas.draw()
+            self.__background = forecast_canvas.copy_from_bbox(
+                self.__figure.bbox)
+            self.__limits = limits
+            self.full_draws += 1
+        else:
+            forecast_canvas.restore_region(self.__background)
+            self.blits += 1
+
+        for artist in [self.__precipitation_fill, self.__precipitation_line]:
+            self.__ax1.draw_artist(artist)
+        for artist in (self.__nights + [self.__temperature_line]
+                       + self.__midnights):
+            if artist.get_visible():
+                self.__ax2.draw_artist(artist)
+
+        #display
+        return Image.frombuffer(
+            'RGBA',
+            forecast_canvas.get_width_height(),
+            forecast_canvas.buffer_rgba(),
+            'raw', 'RGBA', 0, 1).convert('RGB')
+
+    def close(self) -> None:
+        """Release the figure"""
+        if self.__figure is not None:
+            self.__plot.close(self.__figure)
+            self.__figure = None
+            self.__size = None
+
+def __nice_ticks(low: float, high: float, count: int = 5) -> list:
+    """Round tick values covering [low, high], like matplotlib's locator"""
+    if high <= low:
+        high = low + 1
+    raw_step = (high - low) / count
+    magnitude = 10 ** math.floor(math.log10(raw_step))
+    step = next(magnitude * factor for factor in (1, 2, 2.5, 5, 10)
+                if magnitude * factor >= raw_step)
+    first = math.ceil(low / step)
+    return [index * step for index in range(first, math.floor(high / step) + 1)]
+
+def __tick_label(value: float) -> str:
+    return f"{value:g}"
+
+def plot_pil(timestamps: list, temperature: list, precipitation: list,
+        nights: list, x_resolution: int, y_resolution: int) -> Image:
+    """Render forecast with PIL, same arguments as `MatplotlibForecastFigure`
+
+    Uses only black, white and red, so the image quantizes to the panel
+    palette exactly.
+    """
+    #pylint: disable-msg=too-many-locals
+    black = (0x00, 0x00, 0x00)
+    red = (0xFF, 0x00, 0x00)
+    font = __font()
+    image = Image.new('RGB', (x_resolution, y_resolution), (0xFF, 0xFF, 0xFF))
+    draw = ImageDraw.Draw(image)
+
+    # same subplot margins as matplotlib's defaults
+    left = round(x_resolution * 0.125)
+    right = round(x_resolution * 0.9)
+    top = round(y_resolution * 0.12)
+    bottom = round(y_resolution * 0.89)
+    first, last = timestamps[0], timestamps[-1]
+    span = max(last - first, 1)
+
+    def x_of(timestamp):
+        return left + (timestamp - first) * (right - left) / span
+
+    # same limits as `MatplotlibForecastFigure`, including flat data:
+    # precipitation from 0 with 5 % headroom, 5 % temperature margins
+    precipitation_top = max(precipitation) * 1.05 or 1
+    precipitation_ticks = __nice_ticks(0, precipitation_top)
+    temperature_margin = (max(temperature) - min(temperature)) * 0.05 or 1
+    temperature_low = min(temperature) - temperature_margin
+    temperature_span = max(temperature) + temperature_margin - temperature_low
+    temperature_ticks = __nice_ticks(temperature_low,
+                                     temperature_low + temperature_span)
+
+    def y_of_precipitation(value):
+        return bottom - value * (bottom - top) / precipitation_top
+
+    def y_of_temperature(value):
+        return bottom - (value - temperature_low) * (bottom - top) / temperature_span
+
+    #mark nights
+    for sunset, sunrise in nights:
+        night_left, night_right = round(x_of(sunset)), round(x_of(sunrise))
+        draw.point([(x, y) for x in range(night_left + 2, night_right, 4)
+                    for y in range(top + 2, bottom, 4)], fill=black)
+        draw.rectangle((night_left, top, night_right, bottom), outline=black)
+
+    #plot precipitation
+    draw.polygon([(x_of(first), bottom)]
+                 + [(x_of(timestamp), y_of_precipitation(value))
+                    for timestamp, value in zip(timestamps, precipitation)]
+                 + [(x_of(last), bottom)], fill=black)
+
+    #grid lines and labels for temperatures
+    for value in temperature_ticks:
+        y = round(y_of_temperature(value))
+        draw.line((left, y, right, y), fill=black)
+        draw.text((left - 4, y), __tick_label(value), fill=black, font=font,
+                  anchor='rm')
+    for value in precipitation_ticks:
+        y = round(y_of_precipitation(value))
+        draw.line((right, y, right + 3, y), fill=black)
+        draw.text((right + 5, y), __tick_label(value), fill=black, font=font,
+                  anchor='lm')
+
+    #midnights, hour labels and day names
+    hour = datetime.fromtimestamp(first).replace(minute=0, second=0,
+                                                 microsecond=0)
+    while hour.timestamp() <= last:
+        x = round(x_of(hour.timestamp()))
+        if hour.timestamp() >= first:
+            if hour.hour == 0:
+                draw.point([(x, y) for y in range(top, bottom, 3)], fill=red)
+            if hour.hour % 6 == 0:
+                draw.line((x, bottom, x, bottom + 3), fill=black)
+                draw.text((x, bottom + 4), hour.strftime('%H'), fill=black,
+                          font=font, anchor='mt')
+            if hour.hour == 11:
+                draw.text((x, top - 2), hour.strftime('%a'), fill=black,
+                          font=font, anchor='mb')
+        hour += timedelta(hours=1)
+
+    #plot temperatures
+    draw.line([(x_of(timestamp), y_of_temperature(value))
+               for timestamp, value in zip(timestamps, temperature)],
+              fill=red, width=2)
+
+    draw.rectangle((left, top, right, bottom), outline=black)
+    return image
+
+@functools.lru_cache(maxsize=None)
+def __font() -> ImageFont.FreeTypeFont:
+    return ImageFont.truetype('SourceCodePro-Regular.ttf', 11)
+
+# backend name -> factory of renderer callable
+Renderers = {
+    'matplotlib': MatplotlibForecastFigure,
+    'pil': lambda: plot_pil,
+}
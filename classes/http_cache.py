@@ -0,0 +1,185 @@
+# http_cache.py
+"""This module caches JSON API responses in memory and on disk
+"""
+import collections
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+# query parameters never shown in stats
+SecretParameters = ('apikey', 'appid', 'token', 'key')
+
+class HTTPCache:
+    """This class keeps parsed JSON responses with their HTTP validators
+
+    A fresh entry is returned without any request. A stale entry is
+    revalidated with If-None-Match/If-Modified-Since, and a 304 reuses the
+    parsed JSON. Freshness comes from Cache-Control max-age or Expires,
+    otherwise from `ttl` if the response has no validators (ETag or
+    Last-Modified) to revalidate it with; no-store responses are not kept
+    and no-cache responses are always revalidated.
+    """
+    def __init__(self, directory: str = None, ttl: int = 60):
+        """Class constructor
+        Args:
+            directory (str, optional): keep entries on disk too, survives
+                                       restarts
+            ttl (int, optional): freshness in seconds if the server sends none
+        """
+        self.logger = logging.getLogger(type(self).__name__)
+        self.__directory = directory
+        self.__ttl = ttl
+        self.__entries = {}
+        self.__lock = threading.Lock()
+        self.__stats = collections.defaultdict(collections.Counter)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.logger.debug('Class initialized')
+
+    def __path(self, url: str) -> str:
+        # URLs carry API tokens, only a hash goes to disk
+        return os.path.join(self.__directory,
+                            hashlib.sha256(url.encode()).hexdigest() + '.json')
+
+    def __entry(self, url: str) -> dict:
+        """Get entry from memory, falling back to disk"""
+        if url in self.__entries or not self.__directory:
+            return self.__entries.get(url)
+        try:
+            with open(self.__path(url), encoding='utf-8') as cache_file:
+                entry = json.load(cache_file)
+            entry['json'] = json.loads(entry['body'])
+        except (OSError, ValueError, KeyError):
+            return None
+        self.__entries[url] = entry
+        return entry
+
+    def lookup(self, url: str, heuristic: bool = True) -> tuple:
+        """Look up URL before a request
+        Args:
+            url (str): request URL
+            heuristic (bool, optional): False to not trust `ttl` freshness,
+                                        only the server's
+        Returns:
+            tuple: (parsed JSON if fresh else None, conditional request headers)
+        """
+        with self.__lock:
+            entry = self.__entry(url)
+            if entry is None:
+                return None, {}
+            if (time.time() < entry['expires']
+                    and (heuristic or not entry.get('heuristic'))):
+                self.__stats[url]['hits'] += 1
+                return entry['json'], {}
+            headers = {}
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+            return None, headers
+
+    def revalidated(self, url: str, headers: dict) -> object:
+        """Handle 304 Not Modified
+        Args:
+            url (str): request URL
+            headers (dict): response headers
+        Returns:
+            parsed JSON of the cached entry
+        """
+        with self.__lock:
+            entry = self.__entry(url)
+            if entry is None:
+                return None
+            self.__stats[url]['revalidated'] += 1
+            entry['expires'], entry['heuristic'] = self.__expires(
+                headers, validated=True)
+            self.__save(url, entry)
+            return entry['json']
+
+    def store(self, url: str, headers: dict, body: bytes, parsed) -> None:
+        """Keep 200 response
+        Args:
+            url (str): request URL
+            headers (dict): response headers
+            body (bytes): response content
+            parsed: JSON parsed from `body`
+        """
+        with self.__lock:
+            self.__stats[url]['misses'] += 1
+            if 'no-store' in headers.get('Cache-Control', ''):
+                self.__entries.pop(url, None)
+                return
+            expires, heuristic = self.__expires(
+                headers, bool(headers.get('ETag') or headers.get('Last-Modified')))
+            entry = {
+                'etag': headers.get('ETag'),
+                'last_modified': headers.get('Last-Modified'),
+                'expires': expires,
+                'heuristic': heuristic,
+                'body': body.decode('utf-8'),
+                'json': parsed,
+            }
+            self.__entries[url] = entry
+            self.__save(url, entry)
+
+    def __expires(self, headers: dict, validated: bool) -> tuple:
+        """Expiry of response
+        Args:
+            headers (dict): response headers
+            validated (bool): entry has validators to revalidate it with
+        Returns:
+            tuple: (UNIX time, True if only assumed from `ttl`)
+        """
+        cache_control = headers.get('Cache-Control', '')
+        if 'no-cache' in cache_control:
+            return 0.0, False
+        max_age = re.search(r'max-age=(\d+)', cache_control)
+        if max_age:
+            return time.time() + int(max_age.group(1)), False
+        if headers.get('Expires'):
+            try:
+                return (parsedate_to_datetime(headers['Expires']).timestamp(),
+                        False)
+            except (TypeError, ValueError):
+                return 0.0, False
+        if validated:
+            # a conditional request is cheap, and sees changes right away
+            return 0.0, False
+        return time.time() + self.__ttl, True
+
+    def __save(self, url: str, entry: dict) -> None:
+        if not self.__directory:
+            return
+        path = self.__path(url)
+        try:
+            with open(path + '.tmp', 'w', encoding='utf-8') as cache_file:
+                json.dump({key: value for key, value in entry.items()
+                           if key != 'json'}, cache_file)
+            os.replace(path + '.tmp', path)
+        except OSError as error:
+            self.logger.warning("cannot write cache file: %s", error)
+
+    def stats(self) -> dict:
+        """Per-URL hits, revalidations and misses, secrets redacted"""
+        with self.__lock:
+            stats = {}
+            for url, counters in self.__stats.items():
+                requests = sum(counters.values())
+                stats[redact(url)] = dict(
+                    counters,
+                    hit_rate=(counters['hits'] + counters['revalidated'])
+                    / requests if requests else 0.0)
+            return stats
+
+def redact(url: str) -> str:
+    """Hide secret query parameters in URL"""
+    parts = urlsplit(url)
+    query = [(key, '***' if key.lower() in SecretParameters else value)
+             for key, value in parse_qsl(parts.query)]
+    return urlunsplit(parts._replace(query=urlencode(query, safe='*')))
@@ -0,0 +1,36 @@
+# job_chain.py
+"""This module runs a job as a chain of self-rescheduling date jobs
+"""
+from datetime import datetime, timedelta
+
+from apscheduler.schedulers.base import BaseScheduler
+
+def chain(scheduler: BaseScheduler, name: str, func: object,
+        first_run: datetime, next_run: object) -> None:
+    """Run func at first_run, then each time at the date next_run returns
+    The next run is scheduled after func returns or raises. Jobs carry no
+    fixed ID: the scheduler removes a finished date job only after the run
+    may already have added the next one. A date job missing its run date
+    would be dropped, ending the chain, so run dates are at least a second
+    ahead and misfires still run.
+    Args:
+        scheduler (BaseScheduler): scheduler running the jobs
+        name (str): job name
+        func (callable): job
+        first_run (datetime): when to run first
+        next_run (callable): returns datetime of the next run, called after
+                             each run
+    """
+    def run():
+        try:
+            func()
+        finally:
+            add(next_run())
+
+    def add(when: datetime):
+        scheduler.add_job(run, trigger='date',
+                          run_date=max(when, datetime.now()
+                                       + timedelta(seconds=1)),
+                          name=name, misfire_grace_time=None, coalesce=True)
+
+    add(first_run)
@@ -1,51 +1,442 @@
 # json_from_api.py
 """This module wraps requests module to return json data
 """
+import codecs
+import collections
+import contextlib
 import json
 import logging
+import os
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+from PIL import Image
 import requests
+from requests.adapters import HTTPAdapter
+
+from classes.circuit_breaker import CircuitBreaker
+from classes.http_cache import HTTPCache
 
 class JSONFromAPI:
     """This class wraps requests module to return json data
+
+    All instances share one keep-alive `requests.Session` per host. Failed
+    requests (connection errors, timeouts, 429 and 5xx) are retried with
+    jittered exponential backoff. A host failing repeatedly is cut off by
+    its `CircuitBreaker`, and all requests made inside `deadline` share one
+    time budget; running out of it does not count as a failure of the host.
     """
+    # shared by all subclasses, see `configure_cache`
+    http_cache = None
+
+    # warm-start snapshots of subclasses, see `configure_snapshots`
+    snapshot_dir = None
+
+    # shared by all subclasses, see `configure_http`
+    http_config = {
+        'pool_connections': 1,
+        'pool_maxsize': 4,
+        'retries': 2,
+        'backoff': 0.5,
+        'backoff_max': 8.0,
+        'failure_threshold': 5,
+        'reset_timeout': 60.0,
+    }
+    RetryStatus = (429, 500, 502, 503, 504)
+    # seconds one provider update may spend on requests, see `deadline`
+    UpdateBudget = 20.0
+    _sessions = {}
+    _sessions_lock = threading.Lock()
+    _breakers = {}
+    _deadline = threading.local()
+    _http_stats = collections.defaultdict(collections.Counter)
+
+    @classmethod
+    def configure_cache(cls, directory: str = None, ttl: int = 60) -> None:
+        """Enable response cache for all APIs
+        Args:
+            directory (str, optional): keep responses on disk too
+            ttl (int, optional): freshness in seconds if the server sends none
+        """
+        JSONFromAPI.http_cache = HTTPCache(directory, ttl)
+
+    @classmethod
+    def configure_snapshots(cls, directory: str) -> None:
+        """Keep last good state of all APIs on disk
+        Args:
+            directory (str): snapshot directory, one file per class
+        """
+        os.makedirs(directory, exist_ok=True)
+        JSONFromAPI.snapshot_dir = directory
+
+    @classmethod
+    def configure_http(cls, **kwargs) -> None:
+        """Set connection pool and retry parameters for all APIs
+        Args:
+            pool_connections (int, optional): pools kept per session
+            pool_maxsize (int, optional): keep-alive connections per host
+            retries (int, optional): retries after the first attempt
+            backoff (float, optional): first backoff ceiling in seconds,
+                                       doubled on each retry
+            backoff_max (float, optional): backoff ceiling in seconds
+            failure_threshold (int, optional): consecutive failed requests
+                                               opening host's circuit
+            reset_timeout (float, optional): seconds before an open circuit
+                                             is probed again
+        """
+        JSONFromAPI.http_config = dict(JSONFromAPI.http_config, **kwargs)
+        with JSONFromAPI._sessions_lock:
+            for session in JSONFromAPI._sessions.values():
+                session.close()
+            JSONFromAPI._sessions.clear()
+            JSONFromAPI._breakers.clear()
+
+    @classmethod
+    def http_stats(cls) -> dict:
+        """Per-host request, retry and connection reuse counters"""
+        stats = {}
+        with JSONFromAPI._sessions_lock:
+            for host, session in JSONFromAPI._sessions.items():
+                counters = dict(JSONFromAPI._http_stats[host])
+                pools = session.get_adapter(host).poolmanager.pools
+                connections = 0
+                requests_sent = 0
+                for pool_key in pools.keys():
+                    pool = pools[pool_key]
+                    connections += pool.num_connections
+                    requests_sent += pool.num_requests
+                counters['connections'] = connections
+                counters['reused'] = max(requests_sent - connections, 0)
+                counters['circuit'] = JSONFromAPI._breakers[host].stats()
+                stats[host] = counters
+        return stats
+
+    @classmethod
+    def request_count(cls, host: str) -> int:
+        """Requests sent to host so far, retries included
+        Args:
+            host (str): 'scheme://netloc', e.g. 'https://airapi.airly.eu'
+        """
+        return JSONFromAPI._http_stats[host]['requests']
+
+    @staticmethod
+    @contextlib.contextmanager
+    def deadline(seconds: float = None, until: float = None):
+        """Limit total time of all requests made by this thread
+        Nested deadlines only shorten the budget. Worker threads do not
+        inherit it, pass `remaining_until()` to them as `until`.
+        Args:
+            seconds (float, optional): budget from now
+            until (float, optional): `time.monotonic()` value to stop at
+        """
+        outer = getattr(JSONFromAPI._deadline, 'until', None)
+        limits = [limit for limit in (
+            outer, until,
+            time.monotonic() + seconds if seconds is not None else None)
+                  if limit is not None]
+        JSONFromAPI._deadline.until = min(limits) if limits else None
+        try:
+            yield
+        finally:
+            JSONFromAPI._deadline.until = outer
+
+    @staticmethod
+    def remaining_until() -> float:
+        """`time.monotonic()` deadline of this thread, None if unlimited"""
+        return getattr(JSONFromAPI._deadline, 'until', None)
+
     def __init__(self):
         """Class constructor
         """
         self.logger = logging.getLogger(type(self).__name__)
         self.logger.debug('Class initialized')
 
-    def _get_json_from_url(self, url, timeout=10):
-        """Protected: retrives json from URL
+    def __snapshot_path(self, extension: str) -> str:
+        return os.path.join(self.snapshot_dir, type(self).__name__ + extension)
+
+    def _save_snapshot(self, state: dict, image: Image = None) -> None:
+        """Protected: replace snapshot with last good state
         Args:
-            url (str): URL
-            timeout (int, optional): timeout (in seconds), defaults to 10s
+            state (dict): JSON serializable state
+            image (PIL.Image, optional): image stored next to it
+        """
+        if self.snapshot_dir is None:
+            return
+        try:
+            if image is not None:
+                path = self.__snapshot_path('.png')
+                image.save(path + '.tmp', 'PNG')
+                os.replace(path + '.tmp', path)
+            path = self.__snapshot_path('.json')
+            with open(path + '.tmp', 'w', encoding='utf-8') as snapshot_file:
+                json.dump(state, snapshot_file)
+            os.replace(path + '.tmp', path)
+        except OSError as error:
+            self.logger.warning("cannot write snapshot: %s", error)
 
+    def _load_snapshot(self) -> dict:
+        """Protected: last good state saved by `_save_snapshot`
         Returns:
-            :object:`json`: image containing the plot
+            dict: saved state, None if there is none
         """
+        if self.snapshot_dir is None:
+            return None
+        path = self.__snapshot_path('.json')
         try:
-            response = requests.get(url, timeout=timeout)
-            response.raise_for_status()
-        except requests.exceptions.ConnectionError as error:
-            self.logger.warning("HTTP connection error!")
-            self.logger.info(str(error))
+            with open(path, encoding='utf-8') as snapshot_file:
+                state = json.load(snapshot_file)
+            age = time.time() - os.path.getmtime(path)
+        except (OSError, ValueError):
             return None
-        except requests.exceptions.Timeout as error:
-            self.logger.warning("HTTP timeout!")
-            self.logger.info(str(error))
+        self.logger.info("snapshot restored, %.0f s old", age)
+        return state
+
+    def _load_snapshot_image(self) -> Image:
+        """Protected: image saved by `_save_snapshot`, None if there is none"""
+        if self.snapshot_dir is None:
             return None
-        except requests.exceptions.HTTPError as error:
-            self.logger.warning("HTTP Error: %i %s", error.response.status_code,
-                             error.response.reason)
-            self.logger.info(str(error))
+        try:
+            with Image.open(self.__snapshot_path('.png')) as image:
+                return image.convert('RGB')
+        except (OSError, ValueError):
             return None
+
+    @staticmethod
+    def _session(url: str) -> tuple:
+        """Get shared session for URL's host
+        Returns:
+            tuple: (host, requests.Session, CircuitBreaker)
+        """
+        parts = urlsplit(url)
+        host = parts.scheme + '://' + parts.netloc
+        with JSONFromAPI._sessions_lock:
+            if host not in JSONFromAPI._sessions:
+                session = requests.Session()
+                session.mount(host, HTTPAdapter(
+                    pool_connections=JSONFromAPI.http_config['pool_connections'],
+                    pool_maxsize=JSONFromAPI.http_config['pool_maxsize'],
+                    max_retries=0))
+                JSONFromAPI._sessions[host] = session
+                JSONFromAPI._breakers[host] = CircuitBreaker(
+                    host,
+                    JSONFromAPI.http_config['failure_threshold'],
+                    JSONFromAPI.http_config['reset_timeout'])
+            return (host, JSONFromAPI._sessions[host],
+                    JSONFromAPI._breakers[host])
+
+    def _backoff(self, attempt: int, response: requests.Response = None) -> float:
+        """Full-jitter backoff, honouring numeric Retry-After"""
+        ceiling = min(self.http_config['backoff_max'],
+                      self.http_config['backoff'] * 2 ** attempt)
+        if response is not None and response.headers.get('Retry-After', '').isdigit():
+            return min(float(response.headers['Retry-After']),
+                       self.http_config['backoff_max'])
+        return random.uniform(0, ceiling)
+
+    def _request(self, url, timeout=10, headers=None, stream=False):
+        """Protected: GET with retries on the shared session
+        Args:
+            url (str): URL
+            timeout (int, optional): timeout (in seconds), per attempt,
+                                     shortened to the remaining `deadline`
+            headers (dict, optional): request headers
+            stream (bool, optional): do not read the body yet
+        Returns:
+            requests.Response: successful response, None on failure
+        """
+        host, session, breaker = self._session(url)
+        until = self.remaining_until()
+        if until is not None and until <= time.monotonic():
+            self.logger.warning("%s: deadline exceeded, request skipped", host)
+            JSONFromAPI._http_stats[host]['deadline_exceeded'] += 1
+            return None
+        if not breaker.allow():
+            self.logger.warning("%s: circuit open, request skipped", host)
+            return None
+        # a half-open probe slot is held until the outcome is recorded
+        settled = False
+        try:
+            response, outcome = self.__attempts(url, timeout, headers, stream,
+                                                host, session, until)
+            settled = True
+            if outcome == 'success':
+                breaker.success()
+                return response
+            if outcome == 'rejected':
+                # the host is up, the request is wrong
+                breaker.success()
+                JSONFromAPI._http_stats[host]['failures'] += 1
+                return None
+            if outcome == 'expired':
+                # not the host's fault, the breaker only frees a probe slot
+                breaker.release()
+                JSONFromAPI._http_stats[host]['deadline_exceeded'] += 1
+                return None
+            breaker.failure()
+            JSONFromAPI._http_stats[host]['failures'] += 1
+            return None
+        finally:
+            if not settled:
+                breaker.release()
+
+    def __attempts(self, url, timeout, headers, stream, host, session,
+            until) -> tuple:
+        """Send request, retrying failures
+        Returns:
+            tuple: (requests.Response or None, outcome), outcome is
+                   'success', 'rejected' (4xx), 'expired' (our deadline)
+                   or 'failure'
+        """
+        retries = self.http_config['retries']
+        attempt_timeout = timeout
+        for attempt in range(retries + 1):
+            if until is not None:
+                remaining = until - time.monotonic()
+                if remaining <= 0:
+                    return None, 'expired'
+                timeout = min(attempt_timeout, remaining)
+            JSONFromAPI._http_stats[host]['requests'] += 1
+            if attempt:
+                JSONFromAPI._http_stats[host]['retries'] += 1
+            response = None
+            try:
+                response = session.get(url, timeout=timeout, headers=headers,
+                                       stream=stream)
+                response.raise_for_status()
+                return response, 'success'
+            except requests.exceptions.ConnectionError as error:
+                self.logger.warning("HTTP connection error!")
+                self.logger.info(str(error))
+            except requests.exceptions.Timeout as error:
+                self.logger.warning("HTTP timeout!")
+                self.logger.info(str(error))
+                if timeout < attempt_timeout:
+                    # cut short by the deadline, the host may be just slow
+                    return None, 'expired'
+            except requests.exceptions.HTTPError as error:
+                self.logger.warning("HTTP Error: %i %s", error.response.status_code,
+                                 error.response.reason)
+                self.logger.info(str(error))
+                if error.response.status_code not in self.RetryStatus:
+                    return None, 'rejected'
+            except requests.exceptions.RequestException as error:
+                # e.g. ChunkedEncodingError while reading the body
+                self.logger.warning("HTTP error!")
+                self.logger.info(str(error))
+            if attempt < retries:
+                delay = self._backoff(attempt, response)
+                if until is not None and time.monotonic() + delay >= until:
+                    break
+                time.sleep(delay)
+        return None, 'failure'
+
+    def _get_json_from_url(self, url, timeout=10, heuristic=True):
+        """Protected: retrives json from URL
+        Args:
+            url (str): URL
+            timeout (int, optional): timeout (in seconds), defaults to 10s
+            heuristic (bool, optional): False to ask the server again
+                                        unless it declared the cached
+                                        response fresh
+
+        Returns:
+            :object:`json`: parsed response, shared with the cache, do not
+                            modify
+        """
+        headers = {}
+        if self.http_cache is not None:
+            cached, headers = self.http_cache.lookup(url, heuristic)
+            if cached is not None:
+                return cached
+        response = self._request(url, timeout, headers)
+        if response is None:
+            return None
+        if response.status_code == 304 and self.http_cache is not None:
+            return self.http_cache.revalidated(url, response.headers)
         if response.content is None:
             self.logger.error("Undefined error!\n")
             return None
         try:
-            return json.loads(response.content)
+            parsed = json.loads(response.content)
         except json.decoder.JSONDecodeError as error:
             self.logger.warning("JSON parsing error!")
             self.logger.info(str(error))
             return None
-        return None
+        if self.http_cache is not None:
+            self.http_cache.store(url, response.headers, response.content,
+                                  parsed)
+        return parsed
+
+    def _iter_json_array_from_url(self, url, timeout=10, chunk_size=16384,
+            max_element=65536):
+        """Protected: yields elements of JSON array from URL one by one
+        The array is parsed as it arrives, only the current element is kept
+        in memory. Responses are not cached. Stops early once `deadline`
+        passes, or when an element is still incomplete after `max_element`
+        characters, e.g. because it is malformed.
+        Args:
+            url (str): URL
+            timeout (int, optional): timeout (in seconds), defaults to 10s
+            chunk_size (int, optional): bytes read at once
+            max_element (int, optional): longest element (in characters)
+        Yields:
+            parsed array elements
+        """
+        response = self._request(url, timeout, stream=True)
+        if response is None:
+            return
+        until = self.remaining_until()
+        decoder = json.JSONDecoder()
+        text = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        buffer = ''
+        started = False
+        with response:
+            try:
+                for chunk in response.iter_content(chunk_size):
+                    if until is not None and time.monotonic() > until:
+                        self.logger.warning("deadline exceeded, JSON array truncated")
+                        return
+                    buffer += text.decode(chunk)
+                    position = 0
+                    while True:
+                        while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                            position += 1
+                        if position == len(buffer):
+                            break
+                        if not started:
+                            if buffer[position] != '[':
+                                self.logger.warning("JSON array expected")
+                                return
+                            started = True
+                            position += 1
+                            continue
+                        if buffer[position] == ']':
+                            return
+                        try:
+                            element, end = decoder.raw_decode(buffer, position)
+                        except json.decoder.JSONDecodeError:
+                            # element continues in the next chunk
+                            break
+                        following = end
+                        while following < len(buffer) and buffer[following] in ' \t\r\n':
+                            following += 1
+                        if following == len(buffer) or buffer[following] not in ',]':
+                            # complete only when a delimiter follows, numbers
+                            # in particular may continue in the next chunk
+                            break
+                        position = end
+                        yield element
+                    buffer = buffer[position:]
+                    if len(buffer) > max_element:
+                        self.logger.warning(
+                            "JSON parsing error: element over %i characters",
+                            max_element)
+                        return
+            except requests.exceptions.RequestException as error:
+                self.logger.warning("HTTP error while streaming!")
+                self.logger.info(str(error))
+                return
+        if buffer.strip():
+            self.logger.warning("JSON parsing error: truncated array")
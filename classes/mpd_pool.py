@@ -0,0 +1,194 @@
+# mpd_pool.py
+"""This module shares long-lived MPD connections between threads
+"""
+import collections
+import contextlib
+import logging
+import os
+import threading
+import time
+
+import musicpd
+
+__logger = logging.getLogger(__name__)
+__pools = {}
+__pools_lock = threading.Lock()
+
+class MPDPool:
+    """This class keeps connected MPD clients for reuse
+
+    A borrowed client is used by one thread at a time. Clients idle longer
+    than `check_after` are pinged before use, since MPD drops idle
+    connections (connection_timeout, 60 s by default); a client failing
+    with a connection error is discarded and replaced on the next borrow.
+    """
+    def __init__(self, host: str = None, port: int = None, size: int = 4,
+            timeout: float = 10.0, check_after: float = 30.0):
+        """Class constructor
+        Args:
+            host (str, optional): MPD host or socket, musicpd default if None
+            port (int, optional): MPD port, musicpd default if None
+            size (int, optional): most connections open at once
+            timeout (float, optional): socket timeout of commands (in seconds)
+            check_after (float, optional): idle time (in seconds) after which
+                                           a client is pinged before use
+        """
+        self.logger = logging.getLogger(type(self).__name__)
+        self.__host = host
+        self.__port = port
+        self.__size = size
+        self.__timeout = timeout
+        self.__check_after = check_after
+        # (client, last used) pairs, most recently used last
+        self.__idle = collections.deque()
+        self.__open = 0
+        self.__available = threading.Condition()
+        self.__stats = collections.Counter()
+        self.logger.debug('Class initialized')
+
+    def __connect(self) -> musicpd.MPDClient:
+        mpd_client = musicpd.MPDClient()
+        mpd_client.socket_timeout = self.__timeout
+        mpd_client.connect(self.__host, self.__port)
+        self.__stats['connects'] += 1
+        return mpd_client
+
+    def __acquire(self) -> musicpd.MPDClient:
+        """Take idle client, connect new one or wait for one"""
+        with self.__available:
+            while not self.__idle and self.__open >= self.__size:
+                self.__available.wait()
+            if self.__idle:
+                mpd_client, last_used = self.__idle.pop()
+            else:
+                mpd_client, last_used = None, None
+                self.__open += 1
+        if mpd_client is not None:
+            if time.monotonic() - last_used < self.__check_after:
+                self.__stats['reused'] += 1
+                return mpd_client
+            try:
+                mpd_client.ping()
+                self.__stats['reused'] += 1
+                return mpd_client
+            except (musicpd.ConnectionError, OSError):
+                self.__stats['stale'] += 1
+                self.__disconnect(mpd_client)
+        try:
+            return self.__connect()
+        except (musicpd.MPDError, OSError):
+            self.__release(None)
+            raise
+
+    def __release(self, mpd_client: musicpd.MPDClient) -> None:
+        """Return client to pool, None frees its slot"""
+        with self.__available:
+            if mpd_client is None:
+                self.__open -= 1
+            else:
+                self.__idle.append((mpd_client, time.monotonic()))
+            self.__available.notify()
+
+    @staticmethod
+    def __disconnect(mpd_client: musicpd.MPDClient) -> None:
+        try:
+            mpd_client.disconnect()
+        except (musicpd.MPDError, OSError):
+            pass
+
+    @contextlib.contextmanager
+    def client(self, keep_on_error: bool = True):
+        """Borrow connected client
+        Args:
+            keep_on_error (bool, optional): return the client to the pool
+                                            after other than connection
+                                            errors, False if the block may
+                                            leave it mid command list
+        Yields:
+            musicpd.MPDClient: client, not to be kept after the block
+        """
+        mpd_client = self.__acquire()
+        try:
+            yield mpd_client
+        except (musicpd.ConnectionError, OSError):
+            self.__stats['dropped'] += 1
+            self.__disconnect(mpd_client)
+            self.__release(None)
+            raise
+        except BaseException:
+            if keep_on_error:
+                # e.g. CommandError, the connection itself is fine
+                self.__release(mpd_client)
+            else:
+                self.__stats['discarded'] += 1
+                self.__disconnect(mpd_client)
+                self.__release(None)
+            raise
+        self.__release(mpd_client)
+
+    def command_list(self, commands: list, retry: bool = False) -> list:
+        """Run commands in one round-trip (MPD command_list_ok)
+        Args:
+            commands (:list:`tuple`): (command, arguments...) tuples
+            retry (bool, optional): run again on a fresh connection if the
+                                    connection fails, for read-only lists
+        Returns:
+            list: result of each command
+        """
+        for attempt in range(2 if retry else 1):
+            try:
+                # an error inside the list (e.g. unknown command) leaves
+                # the client in command list mode, it is not reused
+                with self.client(keep_on_error=False) as mpd_client:
+                    mpd_client.command_list_ok_begin()
+                    for command, *arguments in commands:
+                        getattr(mpd_client, command)(*arguments)
+                    results = mpd_client.command_list_end()
+                self.__stats['batches'] += 1
+                self.__stats['commands'] += len(commands)
+                return results
+            except (musicpd.ConnectionError, OSError):
+                if attempt or not retry:
+                    raise
+                self.logger.warning("MPD connection lost, retrying")
+        return None
+
+    def run(self, command: str, *arguments):
+        """Run single command
+        Args:
+            command (str): MPD command, e.g. 'setvol'
+            arguments: command arguments
+        Returns:
+            command result
+        """
+        with self.client() as mpd_client:
+            result = getattr(mpd_client, command)(*arguments)
+        self.__stats['commands'] += 1
+        return result
+
+    def stats(self) -> dict:
+        """Connection and command counters"""
+        with self.__available:
+            return dict(self.__stats, open=self.__open, idle=len(self.__idle))
+
+    def close(self) -> None:
+        """Disconnect idle clients"""
+        with self.__available:
+            while self.__idle:
+                mpd_client, _ = self.__idle.pop()
+                self.__disconnect(mpd_client)
+                self.__open -= 1
+
+def shared_pool(**kwargs) -> MPDPool:
+    """Pool shared by this process, created on first use
+    Args:
+        kwargs: `MPDPool` arguments, only used on first call
+    Returns:
+        MPDPool: pool of the current process, connections are not shared
+                 with forked children
+    """
+    with __pools_lock:
+        if os.getpid() not in __pools:
+            __logger.debug('creating MPD pool')
+            __pools[os.getpid()] = MPDPool(**kwargs)
+        return __pools[os.getpid()]
@@ -0,0 +1,144 @@
+# mpd_watcher.py
+"""This module keeps a snapshot of MPD state up to date
+"""
+import collections
+import logging
+import select
+import threading
+import time
+
+import musicpd
+
+class MPDWatcher:
+    """This class follows MPD state from a background thread
+
+    A dedicated connection waits in MPD's `idle` command. Whenever the
+    player, mixer, options or playlist change, status and current song are
+    read again in one command list and the snapshot is replaced as a
+    whole, so readers never see a half-updated one and never wait for MPD.
+    After `idle_timeout` seconds without changes the idle is ended with
+    `noidle` and started again; a connection failing to answer within
+    `timeout` is dropped. A snapshot not confirmed for `max_age` seconds is
+    not handed out.
+    """
+    Subsystems = ('player', 'mixer', 'options', 'playlist')
+
+    def __init__(self, host: str = None, port: int = None,
+            retry_interval: float = 5.0, timeout: int = 10,
+            idle_timeout: float = 30.0, max_age: float = 60.0):
+        """Class constructor
+        Args:
+            host (str, optional): MPD host or socket, musicpd default if None
+            port (int, optional): MPD port, musicpd default if None
+            retry_interval (float, optional): seconds between reconnects
+            timeout (int, optional): socket timeout of commands (in seconds)
+            idle_timeout (float, optional): seconds in idle before checking
+                                            the connection
+            max_age (float, optional): seconds since the snapshot was last
+                                       confirmed before it is not used,
+                                       more than idle_timeout + timeout
+        """
+        self.logger = logging.getLogger(type(self).__name__)
+        self.__host = host
+        self.__port = port
+        self.__retry_interval = retry_interval
+        self.__timeout = timeout
+        self.__idle_timeout = idle_timeout
+        self.__max_age = max_age
+        self.__snapshot = None
+        # time.monotonic() when MPD last answered
+        self.__confirmed = None
+        self.__thread = None
+        self.__reads_lock = threading.Lock()
+        self.connected = False
+        self.updates = 0
+        self.reconnects = 0
+        self.reads = 0
+        self.events = collections.Counter()
+        self.logger.debug('Class initialized')
+
+    def start(self) -> None:
+        """Start watcher thread"""
+        self.__thread = threading.Thread(target=self.__watch,
+                                         name=type(self).__name__, daemon=True)
+        self.__thread.start()
+
+    def snapshot(self) -> dict:
+        """Last known state
+        Returns:
+            dict: 'status', 'commands', 'song' and 'updated' (UNIX time),
+                  None before the first read or if not confirmed for
+                  `max_age` seconds, do not modify
+        """
+        with self.__reads_lock:
+            self.reads += 1
+        confirmed = self.__confirmed
+        if (confirmed is None
+                or time.monotonic() - confirmed > self.__max_age):
+            return None
+        return self.__snapshot
+
+    def __watch(self) -> None:
+        while True:
+            mpd_client = musicpd.MPDClient()
+            mpd_client.socket_timeout = self.__timeout
+            try:
+                mpd_client.connect(self.__host, self.__port)
+                self.connected = True
+                commands = mpd_client.commands()
+                self.__refresh(mpd_client, commands)
+                while True:
+                    mpd_client.send_idle(*self.Subsystems)
+                    ready, _, _ = select.select([mpd_client], [], [],
+                                                self.__idle_timeout)
+                    # a half-open connection times out answering noidle
+                    # instead of idling forever
+                    changed = (mpd_client.fetch_idle() if ready
+                               else mpd_client.noidle())
+                    self.__confirmed = time.monotonic()
+                    if not changed:
+                        continue
+                    for subsystem in changed:
+                        self.events[subsystem] += 1
+                    self.__refresh(mpd_client, commands)
+            except (musicpd.MPDError, OSError) as error:
+                self.logger.warning("MPD watcher disconnected: %s", error)
+            self.connected = False
+            try:
+                mpd_client.disconnect()
+            except (musicpd.MPDError, OSError):
+                pass
+            time.sleep(self.__retry_interval)
+            self.reconnects += 1
+
+    def __refresh(self, mpd_client: musicpd.MPDClient, commands: list) -> None:
+        mpd_client.command_list_ok_begin()
+        mpd_client.status()
+        mpd_client.currentsong()
+        status, song = mpd_client.command_list_end()
+        self.__snapshot = {
+            'status': status,
+            'commands': commands,
+            'song': song,
+            'updated': time.time(),
+        }
+        self.__confirmed = time.monotonic()
+        self.updates += 1
+
+    def stats(self) -> dict:
+        """Update counts and snapshot age"""
+        snapshot = self.__snapshot
+        confirmed = self.__confirmed
+        return {
+            'connected': self.connected,
+            'updates': self.updates,
+            'events': dict(self.events),
+            'reconnects': self.reconnects,
+            'reads': self.reads,
+            # an old snapshot only means nothing changed
+            'age': (time.time() - snapshot['updated']
+                    if snapshot is not None else None),
+            # seconds since MPD last answered, stale above max_age
+            'confirmed_age': (time.monotonic() - confirmed
+                              if confirmed is not None else None),
+        }
@@ -0,0 +1,75 @@
+# playlist_index.py
+"""This module answers "what is playing" from a day's playlist
+"""
+import bisect
+from datetime import datetime
+
+class PlaylistIndex:
+    """This class keeps tracks as time-sorted intervals
+
+    A track lasts until its 'till' time if the playlist has one, otherwise
+    until the next track starts; the last one is assumed to last at most
+    `max_track_seconds`, see `end_estimated`.
+    """
+    def __init__(self, items: list, max_track_seconds: float = 1200.0):
+        """Class constructor
+        Args:
+            items (:list:`dict`): playlist entries with 'since', optional
+                                  'till', 'interpret' and 'track'
+            max_track_seconds (float, optional): length of the last track
+                                                 if its end is unknown
+        """
+        tracks = []
+        for item in items:
+            try:
+                since = datetime.fromisoformat(item['since']).timestamp()
+                till = (datetime.fromisoformat(item['till']).timestamp()
+                        if item.get('till') else None)
+            except (KeyError, TypeError, ValueError):
+                continue
+            tracks.append((since, till, item.get('interpret', "N\\A"),
+                           item.get('track', "N\\A")))
+        tracks.sort(key=lambda track: track[0])
+        self.starts = [track[0] for track in tracks]
+        self.ends = []
+        # True where the end is only assumed from `max_track_seconds`
+        self.estimated = []
+        for index, (since, till, _, _) in enumerate(tracks):
+            last = index + 1 == len(tracks)
+            following = (since + max_track_seconds if last
+                         else self.starts[index + 1])
+            self.ends.append(min(till, following) if till else following)
+            self.estimated.append(last and not till)
+        self.tracks = [(track[2], track[3]) for track in tracks]
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def covers(self, timestamp: float) -> bool:
+        """Check whether timestamp is within the indexed day"""
+        return bool(self.starts) and self.starts[0] <= timestamp < self.ends[-1]
+
+    def at(self, timestamp: float) -> tuple:
+        """Track playing at timestamp
+        Returns:
+            tuple: (artist, title), None if nothing indexed plays then
+        """
+        index = bisect.bisect_right(self.starts, timestamp) - 1
+        if index < 0 or timestamp >= self.ends[index]:
+            return None
+        return self.tracks[index]
+
+    def end_estimated(self, timestamp: float) -> bool:
+        """Check whether the track playing at timestamp has an unknown end"""
+        index = bisect.bisect_right(self.starts, timestamp) - 1
+        return (index >= 0 and timestamp < self.ends[index]
+                and self.estimated[index])
+
+    def next_boundary(self, timestamp: float) -> float:
+        """First track start or end after timestamp, None if none indexed"""
+        index = bisect.bisect_right(self.starts, timestamp) - 1
+        if index >= 0 and timestamp < self.ends[index]:
+            return self.ends[index]
+        if index + 1 < len(self.starts):
+            return self.starts[index + 1]
+        return None
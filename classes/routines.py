@@ -10,6 +10,7 @@ import subprocess
 from typing import List
 import musicpd
 from pywizlight import wizlight, PilotBuilder, exceptions
+from classes import mpd_pool
 
 __logger = logging.getLogger(__name__)
 
@@ -48,8 +49,7 @@ def wakeup(consumer_wakeup_int: multiprocessing.connection.Connection,
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
 
-    mpd_client = musicpd.MPDClient()
-    mpd_client.connect()
+    pool = mpd_pool.shared_pool()
     #eat up all old messages
     while consumer_wakeup_int.poll():
         consumer_wakeup_int.recv()
@@ -59,22 +59,26 @@ def wakeup(consumer_wakeup_int: multiprocessing.connection.Connection,
     bright_stop = 255
     temp_start = 2700
     temp_stop = 6500
-    old_volume = mpd_client.status()['volume']
-
-    mpd_client.clear()
-    mpd_client.setvol(0)
-    mpd_client.add('https://rozhlas.stream/jazz_aac_128.aac')
-    mpd_client.play()
+    # status is read before the rest of the list runs
+    status, *_ = pool.command_list([
+        ('status',),
+        ('clear',),
+        ('setvol', 0),
+        ('add', 'https://rozhlas.stream/jazz_aac_128.aac'),
+        ('play',),
+    ])
+    old_volume = status['volume']
+    # steps are spread over time, one round-trip each on a pooled connection
     interval = duration / steps
     for i in range(steps):
         if consumer_wakeup_int.poll():
             wakeup_flag = consumer_wakeup_int.recv()
         __logger.info("StopFlag/task: %s", str(wakeup_flag))
         if wakeup_flag:
-            mpd_client.setvol(old_volume)
+            pool.run('setvol', old_volume)
             return
         volume=int((i*int(old_volume))/steps)
-        mpd_client.setvol(volume)
+        pool.run('setvol', volume)
         __logger.info("volume: %i", volume)
         bright=int((i * (bright_stop - bright_start) ) / steps + bright_start)
         temp=int((i * (temp_stop - temp_start) ) / steps + temp_start)
@@ -123,9 +127,8 @@ def bulbs_state(config: dict,
     lightbulbs = [wizlight(socket.gethostbyname(ip)) for ip in config['LIGHTBULBS'].values()]
     old_response = 0
 
-    mpd_client = musicpd.MPDClient()
-    mpd_client.connect()
-    old_volume = mpd_client.status()['volume']
+    pool = mpd_pool.shared_pool()
+    old_volume = pool.run('status')['volume']
 
     duration = 3
     steps = 7
@@ -146,7 +149,7 @@ def bulbs_state(config: dict,
             for i in range(steps):
                 volume=int((i*int(old_volume))/steps)
                 try:
-                    mpd_client.setvol(volume)
+                    pool.run('setvol', volume)
                 except musicpd.ConnectionError:
                     __logger.error("musicpd.ConnectionError -volume: %i", volume)
                 __logger.info("volume: %i", volume)
@@ -158,14 +161,12 @@ def bulbs_state(config: dict,
                 __lightbulb_off_helper(lightbulbs)
             )
 
-            mpd_client = musicpd.MPDClient()
-            mpd_client.connect()
-            old_volume = mpd_client.status()['volume']
+            old_volume = pool.run('status')['volume']
 
             for i in range(steps):
                 volume=int(float(old_volume) - (i*int(old_volume))/steps)
                 try:
-                    mpd_client.setvol(volume)
+                    pool.run('setvol', volume)
                 except musicpd.ConnectionError:
                     __logger.error("musicpd.ConnectionError -volume: %i", volume)
                 __logger.info("volume: %i", volume)
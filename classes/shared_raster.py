@@ -0,0 +1,170 @@
+# shared_raster.py
+"""This module hands images between processes through shared memory
+
+Only a small descriptor goes over the pipe: segment name, size, mode,
+version and, for palette images, the palette. Images are stored in a mode
+PIL can map without copying, RGB is widened to RGBX. Each segment starts
+with the version it holds, 0 while being written, so the reader can tell
+a slot reused by a later publish.
+"""
+import atexit
+import logging
+from multiprocessing import resource_tracker, shared_memory
+import struct
+import sys
+
+from PIL import Image
+
+# modes `Image.frombuffer` maps in place, anything else is converted
+MappableModes = ('L', 'P', 'RGBX', 'RGBA', 'CMYK')
+# segment header: version of the image stored after it
+Header = struct.Struct('Q')
+
+class SharedRasterWriter:
+    """This class publishes images into shared memory
+
+    Two segments are used alternately, so the reader can keep using the
+    previous image while the next one is written.
+    """
+    Slots = 2
+
+    def __init__(self):
+        """Class constructor
+        """
+        self.logger = logging.getLogger(type(self).__name__)
+        self.__segments = [None] * self.Slots
+        self.version = 0
+        atexit.register(self.close)
+        self.logger.debug('Class initialized')
+
+    def publish(self, image: Image) -> dict:
+        """Copy image into shared memory
+        Args:
+            image (PIL.Image): image to publish
+        Returns:
+            dict: descriptor for `SharedRasterReader.attach`
+        """
+        if image.mode not in MappableModes:
+            image = image.convert('RGBX' if image.mode == 'RGB' else 'RGBA')
+        data = image.tobytes()
+        self.version += 1
+        slot = self.version % self.Slots
+        segment = self.__segments[slot]
+        if segment is None or segment.size < Header.size + len(data):
+            if segment is not None:
+                self.__unlink(segment)
+            segment = shared_memory.SharedMemory(create=True,
+                                                 size=Header.size + len(data))
+            self.__segments[slot] = segment
+        Header.pack_into(segment.buf, 0, 0)
+        segment.buf[Header.size:Header.size + len(data)] = data
+        Header.pack_into(segment.buf, 0, self.version)
+        descriptor = {
+            'shm': segment.name,
+            'size': image.size,
+            'mode': image.mode,
+            'version': self.version,
+        }
+        if image.mode == 'P':
+            descriptor['palette'] = image.getpalette()
+        return descriptor
+
+    @staticmethod
+    def __unlink(segment: shared_memory.SharedMemory) -> None:
+        segment.close()
+        if sys.version_info < (3, 13):
+            # a reader sharing our resource tracker unregistered it already
+            resource_tracker.register(segment._name, 'shared_memory') #pylint: disable=protected-access
+        segment.unlink()
+
+    def close(self) -> None:
+        """Release and remove all segments"""
+        for slot, segment in enumerate(self.__segments):
+            if segment is None:
+                continue
+            self.__unlink(segment)
+            self.__segments[slot] = None
+
+class SharedRasterReader:
+    """This class maps images published by `SharedRasterWriter`
+    """
+    def __init__(self):
+        """Class constructor
+        """
+        self.logger = logging.getLogger(type(self).__name__)
+        self.__segments = {}
+        self.logger.debug('Class initialized')
+
+    def attach(self, descriptor: dict) -> Image:
+        """Map published image without copying
+        The image changes if the writer reuses the slot, check `current`
+        after reading it.
+        Args:
+            descriptor (dict): descriptor from `SharedRasterWriter.publish`
+        Returns:
+            PIL.Image: read-only image backed by shared memory, None if the
+                       slot no longer holds this version
+        """
+        name = descriptor['shm']
+        if name not in self.__segments:
+            try:
+                self.__segments[name] = self.__open(name)
+            except FileNotFoundError:
+                self.logger.warning("segment %s already removed", name)
+                return None
+            self.__release(keep=SharedRasterWriter.Slots)
+        if not self.current(descriptor):
+            return None
+        segment = self.__segments[name]
+        mode = descriptor['mode']
+        image = Image.frombuffer(mode, tuple(descriptor['size']),
+                                 segment.buf[Header.size:], 'raw', mode, 0, 1)
+        if 'palette' in descriptor:
+            image.putpalette(descriptor['palette'])
+        return image
+
+    @staticmethod
+    def __open(name: str) -> shared_memory.SharedMemory:
+        """Open existing segment without handing it to the resource tracker"""
+        if sys.version_info >= (3, 13):
+            return shared_memory.SharedMemory(name=name, track=False)
+        segment = shared_memory.SharedMemory(name=name)
+        # attaching registers the segment as if created here, the tracker
+        # would unlink it (or warn about it) when this process exits
+        resource_tracker.unregister(segment._name, 'shared_memory') #pylint: disable=protected-access
+        return segment
+
+    def current(self, descriptor: dict) -> bool:
+        """Check whether the slot still holds the described version
+        Args:
+            descriptor (dict): descriptor of an attached image
+        Returns:
+            bool: False once the writer started overwriting the slot
+        """
+        segment = self.__segments.get(descriptor['shm'])
+        return (segment is not None
+                and Header.unpack_from(segment.buf)[0] == descriptor['version'])
+
+    def copy(self, descriptor: dict) -> Image:
+        """Copy published image out of shared memory
+        Args:
+            descriptor (dict): descriptor from `SharedRasterWriter.publish`
+        Returns:
+            PIL.Image: private copy, None if the slot was reused meanwhile
+        """
+        image = self.attach(descriptor)
+        if image is None:
+            return None
+        image = image.copy()
+        if not self.current(descriptor):
+            return None
+        return image
+
+    def __release(self, keep: int) -> None:
+        """Close oldest segments, images still mapping them keep them open"""
+        for name in list(self.__segments)[:-keep]:
+            try:
+                self.__segments[name].close()
+            except BufferError:
+                continue
+            del self.__segments[name]
@@ -0,0 +1,265 @@
+# timeseries.py
+"""This module keeps sensor readings in SQLite with hourly and daily rollups
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+HOUR = 3600
+DAY = 86400
+
+Schema = """
+CREATE TABLE IF NOT EXISTS raw (
+    series TEXT NOT NULL,
+    ts INTEGER NOT NULL,
+    value REAL NOT NULL,
+    PRIMARY KEY (series, ts)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS rollup (
+    series TEXT NOT NULL,
+    resolution INTEGER NOT NULL,
+    bucket INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    sum REAL NOT NULL,
+    min REAL NOT NULL,
+    max REAL NOT NULL,
+    PRIMARY KEY (series, resolution, bucket)
+) WITHOUT ROWID;
+"""
+
+# hourly buckets recomputed from raw rows
+RollupHourly = """
+INSERT INTO rollup (series, resolution, bucket, count, sum, min, max)
+SELECT series, 3600, ts / 3600 * 3600, count(*), sum(value), min(value),
+       max(value)
+FROM raw WHERE series = ? AND ts >= ? AND ts < ? + 3600
+GROUP BY series
+ON CONFLICT (series, resolution, bucket) DO UPDATE SET
+    count = excluded.count, sum = excluded.sum, min = excluded.min,
+    max = excluded.max
+"""
+
+# daily buckets recomputed from hourly buckets
+RollupDaily = """
+INSERT INTO rollup (series, resolution, bucket, count, sum, min, max)
+SELECT series, 86400, bucket / 86400 * 86400, sum(count), sum(sum), min(min),
+       max(max)
+FROM rollup WHERE series = ? AND resolution = 3600
+    AND bucket >= ? AND bucket < ? + 86400
+GROUP BY series
+ON CONFLICT (series, resolution, bucket) DO UPDATE SET
+    count = excluded.count, sum = excluded.sum, min = excluded.min,
+    max = excluded.max
+"""
+
+class TimeSeriesStore:
+    """This class stores numeric readings and answers range queries
+
+    Readings are buffered and written in one transaction per batch. Each
+    batch updates the hourly and daily min/mean/max rollups of the buckets
+    it touched, so long ranges are read from a few rollup rows instead of
+    raw readings. Raw readings and hourly rollups are pruned after their
+    retention, daily rollups are kept. Buckets are aligned to UTC.
+    """
+    Resolutions = {'raw': 0, 'hour': HOUR, 'day': DAY}
+
+    def __init__(self, path: str, raw_days: int = 7, hourly_days: int = 365,
+            batch_size: int = 100, flush_interval: float = 300.0):
+        """Class constructor
+        Args:
+            path (str): database file
+            raw_days (int, optional): retention of raw readings
+            hourly_days (int, optional): retention of hourly rollups
+            batch_size (int, optional): buffered readings written at once
+            flush_interval (float, optional): longest time (in seconds) a
+                                              reading stays buffered
+        """
+        self.logger = logging.getLogger(type(self).__name__)
+        self.__raw_days = raw_days
+        self.__hourly_days = hourly_days
+        self.__batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.__pending = []
+        self.__last_flush = time.monotonic()
+        self.__last_prune = 0.0
+        self.__lock = threading.Lock()
+        self.inserted = 0
+        self.batches = 0
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.__connection = sqlite3.connect(path, check_same_thread=False,
+                                            isolation_level=None)
+        # auto_vacuum only takes effect before the first table exists
+        self.__connection.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        # WAL: the web process reads while the logger process writes
+        self.__connection.execute('PRAGMA journal_mode = WAL')
+        self.__connection.executescript(Schema)
+        # WAL stays consistent on power loss with fewer SD card syncs
+        self.__connection.execute('PRAGMA synchronous = NORMAL')
+        self.logger.debug('Class initialized')
+
+    def add(self, series: str, value: float, timestamp: float = None) -> None:
+        """Buffer reading, written by `flush`
+        Args:
+            series (str): series name, e.g. 'pm25_outside'
+            value (float): reading
+            timestamp (float, optional): UNIX time, now by default
+        """
+        with self.__lock:
+            self.__pending.append((series,
+                                   int(timestamp if timestamp is not None
+                                       else time.time()),
+                                   float(value)))
+        self.flush_if_due()
+
+    def add_json(self, line: str) -> int:
+        """Buffer numeric fields of JSON object line, e.g. from serial port
+        Args:
+            line (str): JSON object, field names become series names
+        Returns:
+            int: number of readings buffered
+        """
+        try:
+            message = json.loads(line)
+        except (TypeError, ValueError):
+            return 0
+        if not isinstance(message, dict):
+            return 0
+        readings = [(key, value) for key, value in message.items()
+                    if isinstance(value, (int, float))
+                    and not isinstance(value, bool)]
+        for key, value in readings:
+            self.add(key, value)
+        return len(readings)
+
+    def flush_if_due(self) -> None:
+        """Flush when the batch is full or the oldest reading waited long"""
+        if (len(self.__pending) >= self.__batch_size
+                or time.monotonic() - self.__last_flush >= self.flush_interval):
+            self.flush()
+
+    def flush(self) -> None:
+        """Write buffered readings and update their rollups"""
+        with self.__lock:
+            self.__last_flush = time.monotonic()
+            if not self.__pending:
+                return
+            pending, self.__pending = self.__pending, []
+            hours = {(series, timestamp // HOUR * HOUR)
+                     for series, timestamp, _ in pending}
+            days = {(series, hour // DAY * DAY) for series, hour in hours}
+            cursor = self.__connection.cursor()
+            try:
+                cursor.execute('BEGIN')
+                cursor.executemany(
+                    'INSERT OR REPLACE INTO raw (series, ts, value) '
+                    'VALUES (?, ?, ?)', pending)
+                cursor.executemany(RollupHourly,
+                                   [(series, hour, hour) for series, hour in hours])
+                cursor.executemany(RollupDaily,
+                                   [(series, day, day) for series, day in days])
+                cursor.execute('COMMIT')
+            except sqlite3.Error as error:
+                if self.__connection.in_transaction:
+                    cursor.execute('ROLLBACK')
+                self.logger.error("cannot store %i readings: %s",
+                                  len(pending), error)
+                return
+            self.inserted += len(pending)
+            self.batches += 1
+            if time.time() - self.__last_prune >= HOUR:
+                self.__prune()
+
+    def __prune(self) -> None:
+        """Drop readings past retention, return freed pages to the FS"""
+        now = time.time()
+        self.__last_prune = now
+        cursor = self.__connection.cursor()
+        try:
+            series_list = [row[0] for row in cursor.execute(
+                'SELECT DISTINCT series FROM rollup WHERE resolution = ?',
+                (DAY,))]
+            cursor.execute('BEGIN')
+            for series in series_list:
+                cursor.execute('DELETE FROM raw WHERE series = ? AND ts < ?',
+                               (series, int(now - self.__raw_days * DAY)))
+                cursor.execute('DELETE FROM rollup WHERE series = ? '
+                               'AND resolution = ? AND bucket < ?',
+                               (series, HOUR,
+                                int(now - self.__hourly_days * DAY)))
+            cursor.execute('COMMIT')
+            cursor.execute('PRAGMA incremental_vacuum')
+        except sqlite3.Error as error:
+            if self.__connection.in_transaction:
+                cursor.execute('ROLLBACK')
+            # retried after the next hour
+            self.logger.error("cannot prune readings: %s", error)
+
+    def series(self) -> list:
+        """Names of stored series"""
+        with self.__lock:
+            return [row[0] for row in self.__connection.execute(
+                'SELECT DISTINCT series FROM rollup WHERE resolution = ?',
+                (DAY,))]
+
+    def resolution(self, start: float, end: float) -> str:
+        """Pick resolution for range: raw up to 2 days if still kept,
+        hourly up to 60 days if still kept, daily otherwise"""
+        now = time.time()
+        span = end - start
+        if span <= 2 * DAY and start >= now - self.__raw_days * DAY:
+            return 'raw'
+        if span <= 60 * DAY and start >= now - self.__hourly_days * DAY:
+            return 'hour'
+        return 'day'
+
+    def query(self, series: str, start: float, end: float = None,
+            resolution: str = None) -> list:
+        """Readings of series in range
+        Args:
+            series (str): series name
+            start (float): UNIX time, inclusive
+            end (float, optional): UNIX time, exclusive, now by default
+            resolution (str, optional): 'raw', 'hour' or 'day', picked by
+                                        `resolution` by default
+        Returns:
+            :list:`tuple`: (timestamp, min, mean, max) per reading or bucket
+        """
+        end = end if end is not None else time.time()
+        resolution = resolution or self.resolution(start, end)
+        with self.__lock:
+            if resolution == 'raw':
+                rows = self.__connection.execute(
+                    'SELECT ts, value, value, value FROM raw '
+                    'WHERE series = ? AND ts >= ? AND ts < ? ORDER BY ts',
+                    (series, int(start), int(end)))
+            else:
+                step = self.Resolutions[resolution]
+                rows = self.__connection.execute(
+                    'SELECT bucket, min, sum / count, max FROM rollup '
+                    'WHERE series = ? AND resolution = ? '
+                    'AND bucket >= ? AND bucket < ? ORDER BY bucket',
+                    (series, step, int(start) // step * step, int(end)))
+            return rows.fetchall()
+
+    def stats(self) -> dict:
+        """Write counters of this process and database size"""
+        with self.__lock:
+            page_count, = self.__connection.execute(
+                'PRAGMA page_count').fetchone()
+            page_size, = self.__connection.execute(
+                'PRAGMA page_size').fetchone()
+        return {
+            'inserted': self.inserted,
+            'batches': self.batches,
+            'pending': len(self.__pending),
+            'bytes': page_count * page_size,
+        }
+
+    def close(self) -> None:
+        """Flush and close database"""
+        self.flush()
+        self.__connection.close()